@@ -0,0 +1,80 @@
+"""Benchmarks the primer compatibility graph's heterodimer check.
+
+Compares `graph.build_edges` with the original pairwise loop over
+`kmers.max_sequential_nt`. The original is only timed on a sample of pairs
+for large primer counts, and its total time is extrapolated from that.
+
+Usage: python benchmarks/build_edges.py [n_primers ...]
+"""
+import itertools
+import random
+import sys
+import time
+
+from swga.graph import build_edges
+from swga.kmers import max_sequential_nt
+
+
+
+class Primer(object):
+
+    def __init__(self, _id, seq):
+        self._id = _id
+        self.seq = seq
+
+
+MAX_BINDING = 3
+MAX_SAMPLED_PAIRS = 200000
+
+
+def random_primers(n, min_size=6, max_size=12):
+    primers = []
+    seqs = set()
+    while len(primers) < n:
+        seq = "".join(
+            random.choice("ACGT")
+            for _ in xrange(random.randint(min_size, max_size)))
+        if seq not in seqs:
+            seqs.add(seq)
+            primers.append(Primer(len(primers) + 1, seq))
+    return primers
+
+
+def pairwise_edges(pairs, max_binding):
+    edges = []
+    for p1, p2 in pairs:
+        if (p1.seq not in p2.seq) and (p2.seq not in p1.seq):
+            if max_sequential_nt(p1.seq, p2.seq) <= max_binding:
+                edges.append([p1._id, p2._id])
+    return edges
+
+
+def main(sizes):
+    random.seed(0)
+    print "{:>8} {:>14} {:>14} {:>10}".format(
+        "primers", "original (s)", "batched (s)", "speedup")
+    for n in sizes:
+        primers = random_primers(n)
+        start = time.time()
+        edges = build_edges(primers, MAX_BINDING)
+        batched = time.time() - start
+
+        n_pairs = n * (n - 1) // 2
+        pairs = itertools.islice(
+            itertools.combinations(primers, 2), MAX_SAMPLED_PAIRS)
+        start = time.time()
+        original_edges = pairwise_edges(pairs, MAX_BINDING)
+        original = time.time() - start
+        if n_pairs <= MAX_SAMPLED_PAIRS:
+            assert original_edges == edges
+            note = ""
+        else:
+            original *= n_pairs / float(MAX_SAMPLED_PAIRS)
+            note = " (extrapolated)"
+
+        print "{:>8} {:>14.2f} {:>14.2f} {:>9.0f}x{}".format(
+            n, original, batched, original / batched, note)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [200, 1000, 5000])
@@ -0,0 +1,52 @@
+"""Benchmarks the set scoring metrics.
+
+Compares `stats.site_metrics` with the original list-based functions
+(`seq_diff`, `mean`, `stdev`, `gini` and `max`) on random sets of sorted
+binding sites, as `score.score_set` gets them from `locate.merge_sites`.
+
+Usage: python benchmarks/stats.py [n_sites ...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from swga import stats
+
+GENOME_LENGTH = 10 ** 8
+REPEATS = 200
+
+
+def list_metrics(sites):
+    diffs = stats.seq_diff(sites.tolist())
+    return (stats.mean(diffs), stats.stdev(diffs), stats.gini(diffs),
+            max(diffs))
+
+
+def array_metrics(sites):
+    metrics = stats.site_metrics(sites)
+    return metrics.mean, metrics.std, metrics.gini, metrics.max
+
+
+def timed(fn, sites):
+    start = time.time()
+    for _ in xrange(REPEATS):
+        result = fn(sites)
+    return (time.time() - start) / REPEATS, result
+
+
+def main(sizes):
+    np.random.seed(0)
+    print "{:>8} {:>14} {:>14} {:>10}".format(
+        "sites", "original (ms)", "numpy (ms)", "speedup")
+    for n in sizes:
+        sites = np.unique(np.random.randint(0, GENOME_LENGTH, n))
+        original, expected = timed(list_metrics, sites)
+        vectorized, result = timed(array_metrics, sites)
+        assert np.allclose(expected, result, rtol=1e-12)
+        print "{:>8} {:>14.3f} {:>14.3f} {:>9.0f}x".format(
+            n, original * 1e3, vectorized * 1e3, original / vectorized)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [100, 1000, 10000, 100000])
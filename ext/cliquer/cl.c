@@ -92,6 +92,8 @@ int main(int argc, char **argv) {
 	opts->user_data=NULL;
 	opts->clique_list=NULL;
 	opts->clique_list_length=0;
+	opts->partition=0;
+	opts->partitions=1;
 
 	/* Report what we are doing. */
 	if (quiet<=1)
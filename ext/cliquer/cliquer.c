@@ -18,7 +18,8 @@
 
 /* Default cliquer options */
 static clique_options clique_default_options_struct = {
-  reorder_by_default, NULL, clique_print_time, NULL, NULL, NULL, NULL, 0, 0
+  reorder_by_default, NULL, clique_print_time, NULL, NULL, NULL, NULL, 0, 0,
+  0, 1
 };
 clique_options *clique_default_options=&clique_default_options_struct;
 
@@ -357,6 +358,11 @@ static int unweighted_clique_search_all(int *table, int start,
 		v=table[i];
 		clique_size[v]=min_size;  /* Do not prune here. */
 
+		/* Skip cliques in other processes' part of the search */
+		if ((opts->partitions > 1) &&
+		    (i % opts->partitions != opts->partition))
+			continue;
+
 		newsize=0;
 		for (j=0; j<i; j++) {
 			if (GRAPH_IS_EDGE(g,v,table[j])) {
@@ -23,6 +23,13 @@ struct _clique_options {
 	set_t *clique_list;
 	int clique_list_length;
         int ecl_max_weight;
+
+	/* Unweighted find_all only searches for cliques whose last vertex
+	 * (in the search order) is at position i, with
+	 * i % partitions == partition. Used to split a search between
+	 * processes. */
+	int partition;
+	int partitions;
 };
 
 extern clique_options *clique_default_options;
@@ -18,6 +18,7 @@ void print_search(graph_t *g);
 boolean record_clique_func(set_t s,graph_t *g,clique_options *opts);
 boolean print_clique_func(set_t s,graph_t *g,clique_options *opts);
 boolean write_clique_func(set_t s,graph_t *g,clique_options *opts);
+boolean write_binary_clique(set_t s,graph_t *g);
 boolean weight_clique_check_func(set_t s,graph_t *g,clique_options *opts);
 void print_clique(set_t s,graph_t *g);
 
@@ -39,6 +40,9 @@ static int *(*reorder)(graph_t *, boolean)=reorder_by_default;
 static char *file;
 static char *output_fp;
 static boolean output_specified=FALSE;
+static boolean binary_output=FALSE;
+static int partition=0;
+static int partitions=1;
 static FILE *output;
 /* Dynamically allocated storage for cliques. */
 static set_t *clique_list;
@@ -108,6 +112,8 @@ int main(int argc, char **argv) {
   opts->clique_list=NULL;
   opts->clique_list_length=0;
   opts->ecl_max_weight=(1.0*bg_len)/bg_freq;
+  opts->partition=partition;
+  opts->partitions=partitions;
 
   /* Report what we are doing. */
   if (quiet<=1)
@@ -183,7 +189,15 @@ void printhelp(char *prog) {
          " -r F  --reorder F    Reorder with function F.  See below for details.\n"
          " -q    --quiet        Suppresses progress output.  Specifying -q twice\n"
          "                      suppresses all output except the actual result.\n"
-         " -o F  --output F     Output results to file F."
+         " -o F  --output F     Output results to file F.\n"
+         " -p I/N --partition I/N  Only search part I (0 to N-1) of N disjoint parts\n"
+         "                      of the search (needs --all and --unweighted).\n"
+         "                      Every part must use the same --reorder function,\n"
+         "                      and it must not be random.\n"
+         " -b    --binary       Write cliques as fixed-size binary records (needs\n"
+         "                      --unweighted and --max N): a uint16 clique size, N\n"
+         "                      uint16 vertex numbers (zero-padded) and a float64\n"
+         "                      bg_len/weight, all in native byte order.\n"
          "\n"
          "Available reordering functions are the following:\n"
          "\n"
@@ -227,14 +241,16 @@ void read_options(int argc, char **argv) {
       { "from-0", no_argument, NULL, '0' },
       { "quiet", no_argument, NULL, 'q' },
       { "output_fp", required_argument, NULL, 'o'},
+      { "binary", no_argument, NULL, 'b' },
+      { "partition", required_argument, NULL, 'p' },
       { "help", no_argument, NULL, 'h' },
       { 0,0,0,0 }
     };
 
-    c=getopt_long(argc,argv,"aswm:M:B:L:xur:1qo:h",
+    c=getopt_long(argc,argv,"aswm:M:B:L:xur:1qo:bp:h",
                   long_options,&option_index);
 #else  /* !ENABLE_LONG_OPTIONS */
-    c=getopt(argc,argv,"aswm:M:B:L:xur:1qo:h-");
+    c=getopt(argc,argv,"aswm:M:B:L:xur:1qo:bp:h-");
 #endif /* !ENABLE_LONG_OPTIONS */
     if (c==-1)
       break;
@@ -341,6 +357,17 @@ void read_options(int argc, char **argv) {
       output_fp=optarg;
       output_specified=TRUE;
       break;
+    case 'b':
+      binary_output=TRUE;
+      break;
+    case 'p':
+      if ((sscanf(optarg,"%d/%d",&partition,&partitions) != 2) ||
+          (partitions < 1) || (partition < 0) || (partition >= partitions)) {
+        fprintf(stderr,"Bad argument: %s\n",optarg);
+        fprintf(stderr,TRYFORHELP);
+        exit(1);
+      }
+      break;
     case 'h':
       printhelp(argv[0]);
       break;
@@ -371,6 +398,22 @@ void read_options(int argc, char **argv) {
     exit(1);
   }
 
+  if (partitions > 1 && (!unweighted || !find_all)) {
+    fprintf(stderr,"Error: --partition requires --unweighted and --all\n");
+    fprintf(stderr,TRYFORHELP);
+    exit(1);
+  }
+  if (partitions > 1 && reorder == reorder_by_random) {
+    fprintf(stderr,"Error: --partition cannot be used with random order\n");
+    fprintf(stderr,TRYFORHELP);
+    exit(1);
+  }
+  if (binary_output && (!unweighted || max_weight<=0)) {
+    fprintf(stderr,"Error: --binary requires --unweighted and --max N\n");
+    fprintf(stderr,TRYFORHELP);
+    exit(1);
+  }
+
   file=argv[optind];
   return;
 }
@@ -428,6 +471,8 @@ boolean write_clique_func(set_t s, graph_t *g, clique_options *opts) {
   int i;
   int num;
   boolean first = TRUE;
+  if (binary_output)
+    return write_binary_clique(s, g);
   for (i=0; i<SET_MAX_SIZE(s); i++) {
     if (SET_CONTAINS(s, i)) {
       num = number1 ? i+1 : i;
@@ -443,6 +488,34 @@ boolean write_clique_func(set_t s, graph_t *g, clique_options *opts) {
   return TRUE;
 }
 
+/*
+ * Binary version of write_clique_func (see --binary).
+ * Each record is the same size, so a reader can decode many at once.
+ */
+boolean write_binary_clique(set_t s, graph_t *g) {
+  static unsigned short *record=NULL;
+  double weight;
+  int i, n=0;
+  if (record==NULL)
+    record=calloc(max_weight+1, sizeof(unsigned short));
+  for (i=0; i<SET_MAX_SIZE(s); i++) {
+    if (SET_CONTAINS(s, i)) {
+      if (n >= max_weight || i+1 > 65535) {
+        fprintf(stderr,"Error: clique does not fit in a binary record\n");
+        exit(1);
+      }
+      record[++n] = number1 ? i+1 : i;
+    }
+  }
+  record[0] = n;
+  for (i=n+1; i<=max_weight; i++)
+    record[i] = 0;
+  weight = (1.0*bg_len)/graph_subgraph_weight(g,s);
+  fwrite(record, sizeof(unsigned short), max_weight+1, output);
+  fwrite(&weight, sizeof(double), 1, output);
+  return TRUE;
+}
+
 /*
  * Records a clique into the clique list using dynamic allocation.
  * Used as opts->user_function.
@@ -129,7 +129,8 @@ setup(
         'melt',
         'pytest',
         'argutils',
-        'semantic_version'
+        'semantic_version',
+        'numpy'
     ],
     classifiers=[
         'Programming Language :: Python',
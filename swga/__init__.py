@@ -16,7 +16,7 @@ __version__ = pkg_resources.require("swga")[0].version
 # A struct-like object that holds basic information about the workspace
 meta = namedtuple(
     "meta",
-    "db_name version fg_file bg_file ex_file fg_length bg_length")
+    "db_name version fg_file bg_file ex_file fg_length bg_length fg_records")
 
 
 def error(msg, exception=True, wrap=True):
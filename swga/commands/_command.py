@@ -1,4 +1,5 @@
 from ConfigParser import SafeConfigParser
+import json
 import abc
 import click
 import argutils
@@ -8,6 +9,7 @@ from swga import (
     message
 )
 import swga.utils as utils
+import swga.locate as locate
 
 
 class Command(object):
@@ -43,6 +45,10 @@ class Command(object):
         self.exclude_fp = meta.ex_file
         self.fg_length = meta.fg_length
         self.bg_length = meta.bg_length
+        # Saves reading the genome to find where its records start and end
+        if meta.fg_records:
+            locate.cache_chromosome_ends(
+                meta.fg_file, json.loads(meta.fg_records))
 
     def parse_args(self, argv, quiet=False):
         args, unknown = self.parser.parse_known_args(argv)
@@ -3,6 +3,7 @@ import os
 from collections import defaultdict
 
 import click
+import numpy as np
 
 from swga import (error, message)
 import swga.kmers
@@ -20,6 +21,10 @@ output_dir = ".swga_tmp"
 class Count(Command):
 
     def run(self):
+        self.cache = None
+        if self.kmer_cache:
+            self.cache = swga.kmers.KmerCache(
+                self.kmer_cache, self.kmer_cache_size * 1024 ** 2)
         if self.input:
             kmers = swga.kmers.parse_kmer_file(self.input)
             self.count_specific_kmers(kmers)
@@ -48,23 +53,24 @@ class Count(Command):
             kmers_by_length[len(kmer)].append(kmer)
 
         for k, mers in kmers_by_length.items():
-            fg = swga.kmers.count_kmers(k, self.fg_genome_fp, output_dir, 1)
-            bg = swga.kmers.count_kmers(k, self.bg_genome_fp, output_dir, 1)
-            primers = []
-            for mer in mers:
-                try:
-                    primers.append(primer_dict(mer, fg, bg, 0, INF, INF))
-                except KeyError:
+            fg = swga.kmers.count_kmers(
+                k, self.fg_genome_fp, output_dir, 1, self.cache)
+            bg = swga.kmers.count_kmers(
+                k, self.bg_genome_fp, output_dir, 1, self.cache)
+            packed, valid = swga.kmers.encode_kmers(mers, k)
+            in_fg = valid & fg.contains(packed)
+            for mer, found in zip(mers, in_fg):
+                if not found:
                     message(
                         "{} does not exist in foreground genome, skipping..."
                         .format(mer))
+            primers = primer_dicts(packed[in_fg], fg, bg, 0, INF, INF)
 
             # Omitting any primers that were returned empty
             # primers = filter(lambda p: p == {}, primers)
-            chunk_size = 199
             message(
-                "Writing {n} {k}-mers into db in blocks of {cs}..."
-                .format(n=len(primers), k=k, cs=chunk_size))
+                "Writing {n} {k}-mers into db..."
+                .format(n=len(primers), k=k))
             Primers.add(primers, add_revcomp=False)
 
     def count_kmers(self):
@@ -82,54 +88,64 @@ class Count(Command):
 
         kmers = []
         for k in xrange(self.min_size, self.max_size + 1):
-            fg = swga.kmers.count_kmers(k, self.fg_genome_fp, output_dir)
-            bg = swga.kmers.count_kmers(k, self.bg_genome_fp, output_dir)
+            fg = swga.kmers.count_kmers(
+                k, self.fg_genome_fp, output_dir, cache=self.cache)
+            bg = swga.kmers.count_kmers(
+                k, self.bg_genome_fp, output_dir, cache=self.cache)
 
             if self.exclude_fp:
                 assert os.path.isfile(self.exclude_fp)
                 ex = swga.kmers.count_kmers(
-                    k, self.exclude_fp, output_dir, self.exclude_threshold)
+                    k, self.exclude_fp, output_dir, self.exclude_threshold,
+                    self.cache)
             else:
-                ex = {}
+                ex = swga.kmers.KmerTable(k)
 
             # Keep kmers found in foreground, merging bg binding values, and
             # excluding those found in the excluded fasta
-
-            kmers = [
-                primer_dict(seq, fg, bg, self.min_fg_bind, self.max_bg_bind,
-                            self.max_dimer_bp)
-                for seq in fg.viewkeys() if seq not in ex.viewkeys()
-            ]
-
-            kmers = filter(lambda x: x != {}, kmers)
+            candidates = fg.kmers[~ex.contains(fg.kmers)]
+            kmers = primer_dicts(
+                candidates, fg, bg, self.min_fg_bind, self.max_bg_bind,
+                self.max_dimer_bp)
 
             nkmers = len(kmers)
 
-            chunk_size = 199
             message(
-                "Writing {n} {k}-mers into db in blocks of {cs}..."
-                .format(n=nkmers * 2, k=k, cs=chunk_size))
+                "Writing {n} {k}-mers into db..."
+                .format(n=nkmers * 2, k=k))
             Primers.add(kmers, add_revcomp=True)
 
         message("Counted kmers in range %d-%d" % (self.min_size, self.max_size))
 
 
-def primer_dict(seq, fg, bg, min_fg_bind, max_bg_bind, max_dimer_bp):
-    fg_freq = fg[seq]
-    bg_freq = bg.get(seq, 0)
-    ratio = fg_freq / float(bg_freq) if bg_freq > 0 else float('inf')
+def primer_dicts(kmers, fg, bg, min_fg_bind, max_bg_bind, max_dimer_bp):
+    """Join packed k-mers against fg/bg counts and return passing primers.
+
+    :param kmers: an array of packed k-mers (see swga.kmers.encode_kmers)
+    :param fg: a KmerTable of foreground counts
+    :param bg: a KmerTable of background counts
+    :returns: a list of primer dicts for the k-mers passing all the checks
+    """
+    fg_freq = fg.lookup(kmers)
+    bg_freq = bg.lookup(kmers)
 
     # Setting to -1 disables the background binding frequency check
     max_bg_bind = INF if max_bg_bind < 0 else max_bg_bind
 
-    if ((fg_freq >= min_fg_bind) and
-            (bg_freq <= max_bg_bind) and
-            # Homodimer check
-            (swga.kmers.max_sequential_nt(seq, seq) <= max_dimer_bp)):
-        return {
-            'seq': seq,
-            'fg_freq': fg_freq,
-            'bg_freq': bg_freq,
-            'ratio': ratio}
-    else:
-        return {}
+    passing = (fg_freq >= min_fg_bind) & (bg_freq <= max_bg_bind)
+    fg_freq = fg_freq[passing]
+    bg_freq = bg_freq[passing]
+    ratio = np.full(len(fg_freq), INF)
+    in_bg = bg_freq > 0
+    ratio[in_bg] = fg_freq[in_bg] / bg_freq[in_bg].astype(float)
+
+    seqs = swga.kmers.decode_kmers(kmers[passing], fg.k)
+    return [
+        {'seq': seq,
+         'fg_freq': fg_f,
+         'bg_freq': bg_f,
+         'ratio': r}
+        for seq, fg_f, bg_f, r in zip(
+            seqs, fg_freq.tolist(), bg_freq.tolist(), ratio.tolist())
+        # Homodimer check
+        if swga.kmers.max_sequential_nt(seq, seq) <= max_dimer_bp]
@@ -152,13 +152,14 @@ def export_lorenz(sets, outfile, fg_genome_fp, header=True):
     if header:
         writer.writeheader()
 
+    chr_ends = swga.locate.chromosome_ends(fg_genome_fp)
     for set in sets:
         # Get the distances between each primer binding site
         primers = list(set.primers)
         # primers = list(Primer.select().where(Primer.seq << primer_seqs).execute())
-        chr_ends = swga.locate.chromosome_ends(fg_genome_fp)
-        binding_sites = swga.locate.linearize_binding_sites(primers, chr_ends)
-        distances = swga.stats.seq_diff(binding_sites)
+        binding_sites = swga.locate.merge_sites(
+            [primer.linear_locations for primer in primers], chr_ends)
+        distances = swga.stats.site_metrics(binding_sites).diffs
 
         lorenz = swga.stats.lorenz(distances)
         lorenz_str = ",".join(str(d) for d in lorenz)
@@ -25,6 +25,8 @@ class Filter(Command):
 
         assert isinstance(primers, Primers)
 
+        self.workspace.index_primers()
+
         # Undo all active marks, if any
         Primer.update(active=False).execute()
 
@@ -36,7 +38,8 @@ class Filter(Command):
                 .summarize()
                 .filter_tm_range(self.min_tm, self.max_tm)
                 .limit_to(self.max_primers)
-                .filter_max_gini(self.max_gini, self.fg_genome_fp)
+                .filter_max_gini(
+                    self.max_gini, self.fg_genome_fp, self.workers)
             )
 
         primers.activate(self.max_primers)
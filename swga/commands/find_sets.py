@@ -1,4 +1,10 @@
+import collections
 import functools
+import heapq
+import itertools
+import multiprocessing
+import signal
+import time
 
 import click
 
@@ -9,13 +15,193 @@ import swga.sets as sets
 from swga.primers import Primers
 from swga import (warn, message)
 from swga.commands._command import Command
-from swga.workspace import Set
+from swga.workspace import Set, PrimerSet, SetWriter
 
 GRAPH_FP = "compatibility_graph.dimacs"
 STATUS_LINE = '''\
 \rSets: {: ^5,.6g} | Passed: {: ^5,.6g} | Smallest max bind dist:{: ^12,.4G}\
 '''
 
+# Number of set_finder lines sent to a scoring worker at a time
+SCORE_BATCH = 64
+# Number of batches each scoring worker can have waiting before reading any
+# more set_finder output
+MAX_PENDING_BATCHES = 4
+# With a time limit on finding better sets, the seconds to wait for
+# set_finder output before checking the limit again
+STALL_CHECK_INTERVAL = 1
+
+# The scorer used by scoring workers; set before the pool is started so that
+# the workers inherit it (and its location cache) when they're forked
+_scorer = None
+
+
+class SetScorer(object):
+
+    """Scores the sets output by set_finder using cached primer locations."""
+
+    def __init__(self, locations, chr_ends, max_fg_bind_dist, score_fun):
+        self.locations = locations
+        self.chr_ends = chr_ends
+        self.max_fg_bind_dist = max_fg_bind_dist
+        self.score_fun = score_fun
+
+    def score_line(self, line):
+        """Score the set in a line of set_finder output.
+
+        :param line: a line of text output, or a (primer_ids, weight) tuple
+        decoded from binary output
+        :returns: the primer ids, score, metrics and max distance between
+        binding sites of the set, or None if the line couldn't be read
+        """
+        if isinstance(line, tuple):
+            primer_ids, bg_dist_mean = line
+        else:
+            try:
+                primer_ids, bg_dist_mean = score.read_set_finder_line(line)
+            except ValueError:
+                return None
+        set_score, variables, max_dist = score.score_set(
+            primers=self.locations.primers(primer_ids),
+            max_fg_bind_dist=self.max_fg_bind_dist,
+            bg_dist_mean=bg_dist_mean,
+            chr_ends=self.chr_ends,
+            score_fun=self.score_fun,
+            interactive=False,
+            sites=self.locations.sites(primer_ids))
+        return primer_ids, set_score, variables, max_dist
+
+
+class TopSets(object):
+
+    """Keeps the best-scoring sets found so far, up to a fixed number.
+
+    Lower scores are better (as in `swga summary`). The sets are held in a
+    heap with the worst kept set on top, so each new set is compared against
+    it and replaces it if it scores better.
+
+    Also tracks how long it's been since the kept sets last changed, in
+    seconds and sets seen, to tell when to stop searching.
+    """
+
+    def __init__(self, size, stop_after_time=0, stop_after_sets=0):
+        """
+        :param size: the number of sets to keep
+        :param stop_after_time: see `stalled` (< 1 for no limit)
+        :param stop_after_sets: see `stalled` (< 1 for no limit)
+        """
+        self.size = size
+        self.stop_after_time = stop_after_time
+        self.stop_after_sets = stop_after_sets
+        # True if the kept sets have changed since the last checkpoint
+        self.changed = False
+        self.seen = 0
+        self._heap = []
+        self._improved_at = time.time()
+        self._seen_at_improvement = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, primer_ids, set_score, variables):
+        """Consider a set for keeping.
+
+        :param set_score: the set's score, or False if it didn't pass
+        :returns: True if the set was kept
+        """
+        self.seen += 1
+        if set_score is False:
+            return False
+        # Ties go to the set found first: the set found last is on top
+        entry = (-set_score, -self.seen, primer_ids, variables)
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, entry)
+        elif entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+        else:
+            return False
+        self.changed = True
+        self._improved_at = time.time()
+        self._seen_at_improvement = self.seen
+        return True
+
+    def sets(self):
+        """Return the kept sets as (primer_ids, score, variables), best first."""
+        return [
+            (primer_ids, -neg_score, variables)
+            for neg_score, _, primer_ids, variables
+            in sorted(self._heap, reverse=True)]
+
+    def stalled(self):
+        """True if the kept sets haven't changed in `stop_after_time` seconds
+        or `stop_after_sets` sets."""
+        return (
+            (self.stop_after_time > 0 and
+             time.time() - self._improved_at >= self.stop_after_time) or
+            (self.stop_after_sets > 0 and
+             self.seen - self._seen_at_improvement >= self.stop_after_sets))
+
+
+def _init_score_worker():
+    # Ctrl-C is handled by the main process, which shuts down the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _score_lines(lines):
+    return [(line, _scorer.score_line(line)) for line in lines]
+
+
+def _score_each(scorer, setfinder_lines):
+    for line in setfinder_lines:
+        # set_finder hasn't output anything for a while (see sets.find)
+        if line is None:
+            yield None, None
+        else:
+            yield line, scorer.score_line(line)
+
+
+def _score_in_pool(scorer, setfinder_lines, workers):
+    """Score set_finder lines in a pool of worker processes.
+
+    Lines are sent to the workers in batches, and no more lines are read while
+    `MAX_PENDING_BATCHES` per worker are waiting to be scored. Results are
+    yielded in the same order as the lines. If set_finder hasn't output
+    anything for a while (a None line), the lines so far are scored and
+    yielded, followed by (None, None).
+    """
+    global _scorer
+    _scorer = scorer
+    pool = multiprocessing.Pool(workers, initializer=_init_score_worker)
+    pending = collections.deque()
+    try:
+        while True:
+            batch = []
+            idle = False
+            for line in itertools.islice(setfinder_lines, SCORE_BATCH):
+                if line is None:
+                    idle = True
+                    break
+                batch.append(line)
+            if batch:
+                pending.append(pool.apply_async(_score_lines, (batch,)))
+            if idle:
+                while pending:
+                    for result in pending.popleft().get(1e9):
+                        yield result
+                yield None, None
+                continue
+            if not pending:
+                break
+            if not batch or len(pending) >= workers * MAX_PENDING_BATCHES:
+                # A timeout is given so that the wait can be interrupted by
+                # Ctrl-C (a known limitation of multiprocessing in Python 2)
+                for result in pending.popleft().get(1e9):
+                    yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _scorer = None
+
 
 class FindSets(Command):
 
@@ -30,14 +216,18 @@ class FindSets(Command):
             self.workspace.reset_sets()
 
         self.chr_ends = locate.chromosome_ends(self.fg_genome_fp)
-        # Evaluate the scoring expression from a string and return it as a
-        # callable function
+        # The scoring expression is parsed and checked once, up front
         self.score_fun = functools.partial(
             score.default_score_set,
-            expression=self.score_expression)
+            expression=score.ScoreExpression(self.score_expression))
 
         graph.build_graph(self.max_dimer_bp, GRAPH_FP)
 
+        # The sites of every active primer are loaded up front (after the
+        # graph assigns their ids) so that each set can be scored without
+        # querying the database
+        self.locations = locate.LocationCache(Primers.select_active())
+
         message(
             "Finding sets. If nothing appears, try relaxing your parameters.")
 
@@ -47,57 +237,120 @@ class FindSets(Command):
             max_size=self.max_size,
             bg_length=self.bg_length,
             graph_fp=GRAPH_FP,
-            workers=self.workers)
-        self.process_lines(setfinder_lines)
+            workers=self.workers,
+            # Primer ids must fit in set_finder's binary records
+            binary=len(self.locations) <= sets.MAX_BINARY_ID,
+            timeout=(STALL_CHECK_INTERVAL
+                     if self.top_sets > 0 and self.stop_after_time > 0
+                     else None))
+        with self.workspace.write_mode(self.journal_mode, self.synchronous):
+            self.process_lines(setfinder_lines)
+
+    def score_lines(self, setfinder_lines):
+        """Score each line of set_finder output, yielding (line, result).
+
+        With more than one scoring worker, sets are scored in a process pool.
+        """
+        scorer = SetScorer(
+            self.locations, self.chr_ends, self.max_fg_bind_dist,
+            self.score_fun)
+        if self.score_workers > 1:
+            return _score_in_pool(scorer, setfinder_lines, self.score_workers)
+        return _score_each(scorer, setfinder_lines)
 
     def process_lines(self, setfinder_lines):
         passed = processed = 0
         smallest_max_dist = float('inf')
+        scored = self.score_lines(setfinder_lines)
+        top = None
+        if self.top_sets > 0:
+            top = TopSets(
+                self.top_sets, self.stop_after_time, self.stop_after_sets)
+            last_checkpoint = time.time()
 
         try:
-            for line in setfinder_lines:
-                try:
-                    primer_ids, bg_dist_mean = score.read_set_finder_line(line)
-                except ValueError:
-                    warn("Could not parse line:\n\t" + line)
-                    continue
-
-                primers = Primers.select_by_ids(primer_ids)
-                processed += 1
-
-                set_score, variables, max_dist = score.score_set(
-                    primers=primers,
-                    max_fg_bind_dist=self.max_fg_bind_dist,
-                    bg_dist_mean=bg_dist_mean,
-                    chr_ends=self.chr_ends,
-                    score_fun=self.score_fun,
-                    interactive=False
-                )
-
-                if max_dist < smallest_max_dist:
-                    smallest_max_dist = max_dist
-
-                message(
-                    STATUS_LINE.format(processed, passed, smallest_max_dist),
-                    newline=False)
-
-                # Return early if the set doesn't pass
-                if set_score is False:
-                    continue
-                else:
-                    passed += 1
-
-                Set.add(
-                    _id=passed,
-                    primers=primers,
-                    score=set_score,
-                    scoring_fn=self.score_expression,
-                    **variables)
-
-                if passed >= self.max_sets:
-                    message("\nDone (scored %i sets)" % passed)
-                    break
+            with SetWriter(self.flush_interval) as writer:
+                for line, result in scored:
+                    if line is None:
+                        # No new sets for a while; only the time limit can
+                        # have been reached
+                        if top.stalled():
+                            message(
+                                "\nStopping: the best sets haven't changed "
+                                "within stop_after_time")
+                            break
+                        continue
+                    if result is None:
+                        warn("Could not parse line:\n\t" + line)
+                        continue
+
+                    primer_ids, set_score, variables, max_dist = result
+                    processed += 1
+
+                    if max_dist < smallest_max_dist:
+                        smallest_max_dist = max_dist
+
+                    message(
+                        STATUS_LINE.format(
+                            processed, passed, smallest_max_dist),
+                        newline=False)
+
+                    if top is not None:
+                        top.add(primer_ids, set_score, variables)
+                        if (top.changed and time.time() - last_checkpoint >=
+                                self.checkpoint_interval):
+                            self.checkpoint(top)
+                            last_checkpoint = time.time()
+                        if top.stalled():
+                            message(
+                                "\nStopping: the best sets haven't changed "
+                                "within stop_after_time or stop_after_sets")
+                            break
+
+                    # Return early if the set doesn't pass
+                    if set_score is False:
+                        continue
+                    else:
+                        passed += 1
+
+                    if top is None:
+                        writer.add(
+                            _id=passed,
+                            primers=self.locations.primers(primer_ids),
+                            score=set_score,
+                            scoring_fn=self.score_expression,
+                            **variables)
+
+                    if passed >= self.max_sets:
+                        message("\nDone (scored %i sets)" % passed)
+                        break
         finally:
+            # Stops the scoring workers, if any
+            scored.close()
             # Raises a GeneratorExit inside the find_sets command, prompting it
             # to quit the subprocess
             setfinder_lines.close()
+            if top is not None:
+                if top.changed:
+                    self.checkpoint(top)
+                message("Kept the {:,} best of {:,} sets found.".format(
+                    len(top), top.seen))
+
+    def checkpoint(self, top):
+        """Replace the sets in the workspace with the best sets found so far.
+
+        The sets are numbered from 1 (the best).
+        """
+        with self.workspace.atomic():
+            PrimerSet.delete().execute()
+            Set.delete().execute()
+            with SetWriter(self.flush_interval) as writer:
+                for i, (primer_ids, set_score, variables) in enumerate(
+                        top.sets()):
+                    writer.add(
+                        _id=i + 1,
+                        primers=self.locations.primers(primer_ids),
+                        score=set_score,
+                        scoring_fn=self.score_expression,
+                        **variables)
+        top.changed = False
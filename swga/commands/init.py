@@ -11,6 +11,7 @@ use (since it creates the parameters file).
 """
 
 import click
+import json
 import subprocess
 import argparse
 from click._compat import filename_to_ui
@@ -24,7 +25,8 @@ from swga import (
     __version__
 )
 from swga.commands import create_config_file
-from pyfaidx import Fasta
+from swga.genome import Genome
+import swga.locate as locate
 
 version = __version__
 
@@ -178,7 +180,8 @@ def main(argv=None):
             'bg_file': bg_genome_fp,
             'ex_file': exclude_fp,
             'fg_length': fg_length,
-            'bg_length': bg_length
+            'bg_length': bg_length,
+            'fg_records': json.dumps(locate.genome_layout(fg_genome_fp))
         }
 
     # Done!
@@ -212,15 +215,16 @@ def fasta_len_quick(fasta_fp):
 def fasta_stats(fasta_fp):
     """
     Retrieves the number of bases and number of records in a FASTA file. Also
-    creates a FASTA index (.fai) for later searching. May be slow for very
-    large files.
+    creates a 2-bit packed copy of the genome (.swga2bit) for later searching
+    (see swga.genome.packed_fp for where it goes). May be slow for very large
+    files.
     """
     # pyfaidx can't handle blank lines within records, so we have to check :(
     check_empty_lines(fasta_fp)
     try:
-        fasta = Fasta(fasta_fp)
+        genome = Genome.open(fasta_fp)
         length = fasta_len_quick(fasta_fp)
-        nrecords = len(fasta.keys())
+        nrecords = len(genome.keys())
         return length, nrecords
     except:
         click.secho(
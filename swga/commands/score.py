@@ -1,5 +1,6 @@
 import click
 import functools
+import time
 from peewee import fn
 
 import swga.workspace as workspace
@@ -8,19 +9,22 @@ import swga.utils as utils
 import swga.score as score
 import swga.locate as locate
 from swga.primers import Primers
+from swga.dimers import DimerTable
 from _command import Command
-from swga.workspace import Set
+from swga.workspace import Set, Primer, PrimerSet
 
 
 class Score(Command):
 
     def run(self):
         self.chr_ends = locate.chromosome_ends(self.fg_genome_fp)
-        # Evaluate the scoring expression from a string and return it as a
-        # callable function
+        if self.rescore_all:
+            self.rescore_sets()
+            return
+        # The scoring expression is parsed and checked once, up front
         self.score_fun = functools.partial(
             score.default_score_set,
-            expression=self.score_expression)
+            expression=score.ScoreExpression(self.score_expression))
 
         primers = Primers(self.input)
         if len(primers) == 0:
@@ -39,6 +43,10 @@ class Score(Command):
             interactive=True
         )
 
+        seqs = [primer.seq for primer in primers]
+        message("Longest heterodimer between primers: {} bp".format(
+            DimerTable(seqs).max_dimer_within(seqs)))
+
         do_add_set, set_id = self.user_add_set(set_score, variables)
 
         if do_add_set:
@@ -55,6 +63,35 @@ class Score(Command):
             else:
                 message("That primer set already exists.")
 
+    def rescore_sets(self):
+        """Rescore every set in the database with the score expression."""
+        start = time.time()
+        expression = score.ScoreExpression(self.score_expression)
+        sets = Set.primer_seqs_by_set()
+        if not sets:
+            error("No sets found in database, aborting.", exception=False)
+        primers = Primer.select().where(
+            Primer.seq << PrimerSet.select(PrimerSet.primer))
+        locations = locate.LocationCache(primers, key='seq')
+        set_ids = sorted(sets)
+        # Sets are rescored with the bg_dist_mean they were found with
+        stored = dict(Set.select(Set._id, Set.bg_dist_mean).tuples())
+        bg_dist_means = [
+            score.calculate_bg_dist_mean(
+                locations.primers(sets[_id]), self.bg_length)
+            if stored[_id] is None else stored[_id]
+            for _id in set_ids]
+        scores, _ = score.score_sets(
+            expression=expression,
+            primer_sets=[sets[_id] for _id in set_ids],
+            locations=locations,
+            chr_ends=self.chr_ends,
+            bg_length=self.bg_length,
+            bg_dist_means=bg_dist_means)
+        Set.update_scores(set_ids, scores, self.score_expression)
+        message("Rescored {:,} sets in {:.1f}s.".format(
+            len(set_ids), time.time() - start))
+
     def user_add_set(self, set_score, variables):
         """Output set statistics and prompt the user to add the set."""
         set_dict = dict(
@@ -0,0 +1,101 @@
+"""dimers.py
+
+The longest heterodimer (run of complementary bases) between pairs of primers.
+
+Heterodimers only depend on the primer sequences, so they are stored in the
+workspace as they are computed and never computed twice: opening a DimerTable
+only aligns the sequences that haven't been seen before, and after that any
+pair can be looked up in constant time.
+"""
+import numpy as np
+
+from swga.kmers import pairwise_max_sequential_nt
+from swga.workspace import (
+    _db, _dimers, _insert_in_chunks, SQLITE_MAX_VARIABLES)
+
+
+class DimerTable(object):
+
+    """The heterodimer lengths between each pair of a list of primers."""
+
+    def __init__(self, seqs):
+        """Load (computing and storing any that are missing) the heterodimer
+        lengths between every pair of seqs.
+
+        :param seqs: the primer sequences
+        """
+        self.seqs = list(seqs)
+        self.index = {seq: i for i, seq in enumerate(self.seqs)}
+        self.matrix = _load(self.seqs)
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __contains__(self, seq):
+        return seq in self.index
+
+    def max_dimer(self, seq1, seq2):
+        """Return the longest run of complementary bases between two primers
+        (see kmers.max_sequential_nt)."""
+        return int(self.matrix[self.index[seq1], self.index[seq2]])
+
+    def max_dimer_within(self, seqs):
+        """Return the longest heterodimer between any two different primers
+        in a list, or 0 if there are fewer than two."""
+        rows = [self.index[seq] for seq in set(seqs)]
+        if len(rows) < 2:
+            return 0
+        lengths = self.matrix[np.ix_(rows, rows)]
+        return int(lengths[np.triu_indices(len(rows), 1)].max())
+
+
+def _load(seqs):
+    """Return the n x n matrix of heterodimer lengths between seqs."""
+    # Workspaces made by older versions of swga don't have the table yet
+    _dimers.create_table(fail_silently=True)
+    stored = dict(_dimers.select(_dimers.seq, _dimers.idx).tuples())
+    lengths = _add(
+        [seq for seq in sorted(set(seqs)) if seq not in stored], stored)
+
+    missing = [seq for seq in set(seqs) if seq not in lengths]
+    # Stay under SQLite's limit on the number of parameters in a query
+    for i in xrange(0, len(missing), SQLITE_MAX_VARIABLES):
+        chunk = missing[i:i + SQLITE_MAX_VARIABLES]
+        query = (_dimers.select(_dimers.seq, _dimers.lengths)
+                 .where(_dimers.seq << chunk).tuples())
+        for seq, row in query:
+            lengths[seq] = np.frombuffer(row, dtype=np.uint8)
+
+    idx = np.array([stored[seq] for seq in seqs], dtype=np.int64)
+    matrix = np.zeros((len(seqs), len(seqs)), dtype=np.uint8)
+    for i, seq in enumerate(seqs):
+        earlier = idx <= idx[i]
+        matrix[i, earlier] = lengths[seq][idx[earlier]]
+    return np.maximum(matrix, matrix.T)
+
+
+def _add(new, stored):
+    """Compute and store the heterodimer lengths for new sequences.
+
+    :param new: sequences that aren't in the table
+    :param stored: the {seq: idx} of the sequences in the table; updated
+    with the new sequences
+    :returns: a {seq: lengths} dict for the new sequences
+    """
+    if not new:
+        return {}
+    order = sorted(stored, key=stored.get) + new
+    first = len(stored)
+    values = pairwise_max_sequential_nt(new, order)
+    lengths = {}
+    rows = []
+    for i, seq in enumerate(new):
+        stored[seq] = first + i
+        lengths[seq] = values[i, :first + i + 1]
+        rows.append({
+            'seq': seq,
+            'idx': first + i,
+            'lengths': buffer(lengths[seq].tostring())})
+    with _db.atomic():
+        _insert_in_chunks(_dimers, rows)
+    return lengths
@@ -1,6 +1,8 @@
 import os
 from types import *
-from collections import Counter
+
+import numpy as np
+
 from . import (warn, message)
 from workspace import Set
 import locate
@@ -24,9 +26,10 @@ class BedFile(object):
         self.set = set
         self.fg_genome_fp = fg_genome_fp
 
-    def _primer_sites(self, primer):
+    def _primer_sites(self, primer, chr_ends):
         seq = primer.seq
-        for record_name, locations in primer.locations.iteritems():
+        for record_name, locations in (
+                primer.record_locations(chr_ends).iteritems()):
             for location in locations:
                 yield record_name, location, location + len(seq)
 
@@ -43,6 +46,7 @@ class BedFile(object):
             "set_%s" % self.set._id)
 
         whole_set_fp = os.path.join(output_folder, 'whole_set.bed')
+        chr_ends = locate.chromosome_ends(self.fg_genome_fp)
 
         with open(whole_set_fp, 'wb') as whole_set_file:
             whole_set_file.write("track name=Set_{}\n".format(self.set._id))
@@ -51,7 +55,8 @@ class BedFile(object):
                 primer_fp = os.path.join(output_folder, seq + ".bed")
                 with open(primer_fp, 'wb') as primer_file:
                     primer_file.write("track name={}\n".format(seq))
-                    for record_name, start, end in self._primer_sites(primer):
+                    sites = self._primer_sites(primer, chr_ends)
+                    for record_name, start, end in sites:
                         recordstr = "{} {} {}\n".format(
                             record_name, start, end)
                         primer_file.write(recordstr)
@@ -86,13 +91,20 @@ class BedGraph(object):
 
     def _hits_per_record(self):
         '''
-        Calculates the number of bases covered by primers in each record, and
-        yields the record name, midpoint of the record, and number of hits as
-        a tuple.
+        Counts the primer binding sites in each window of each record, and
+        yields the record name, and arrays of the midpoints of the windows
+        and the number of hits in each, as a tuple.
+
+        The binding sites are sorted once, so the hits in every window are
+        found with two binary searches, whatever the window size.
         '''
         record_ends = locate.chromosome_ends(self.fg_genome_fp)
-        for record_name, ends in record_ends.iteritems():
-            record_length = ends[1] + 1
+        # Sites on the linearized genome, with one entry per primer binding
+        sites = np.sort(np.concatenate(
+            [primer.linear_locations for primer in self.set.primers]))
+        for record_name in sorted(record_ends, key=record_ends.get):
+            record_start, record_end = record_ends[record_name]
+            record_length = record_end - record_start + 1
 
             # Check window size <= record_length and fix if not
             this_window_size = self.window_size
@@ -110,21 +122,19 @@ class BedGraph(object):
                     "In [{}]: step size larger than window size ({}), set to {}"
                     .format(record_name, this_window_size, this_step_size))
 
-            # Count the number of primers that bind in the current record
-            counter = Counter()
-            for primer in self.set.primers:
-                counter.update(Counter(primer.locations[record_name]))
-
-            starting_positions = xrange(
-                0, int(record_length - this_window_size), this_step_size)
+            # The sites in the current record
+            first, last = np.searchsorted(
+                sites, [record_start, record_end + 1])
+            record_sites = sites[first:last] - record_start
 
-            for start in starting_positions:
-                end = start + this_window_size
-                midpoint = (end + start) / 2
-                # Add each base's count to get the number of bases covered
-                hits = sum([counter[i] for i in xrange(start, end)])
+            starts = np.arange(
+                0, record_length - this_window_size, this_step_size)
+            ends = starts + this_window_size
+            midpoints = (ends + starts) // 2
+            hits = (np.searchsorted(record_sites, ends) -
+                    np.searchsorted(record_sites, starts))
 
-                yield record_name, midpoint, hits
+            yield record_name, midpoints, hits
 
     def write(self, output_fp):
         """Writes the bedgraph to a file in a directory named after the set."""
@@ -141,9 +151,12 @@ class BedGraph(object):
         with open(bedgraph_fp, 'wb') as bedgraph_file:
             typestr = "track type=bedGraph {}\n".format(self.opts_str)
             bedgraph_file.write(typestr)
-            for record_name, midpoint, hits in self._hits_per_record():
-                linestr = "{} {} {} {}\n".format(
-                    record_name, midpoint, midpoint, hits)
-                bedgraph_file.write(linestr)
+            # Written a record at a time
+            for record_name, midpoints, hits in self._hits_per_record():
+                bedgraph_file.writelines(
+                    "{} {} {} {}\n".format(
+                        record_name, midpoint, midpoint, hit)
+                    for midpoint, hit in zip(
+                        midpoints.tolist(), hits.tolist()))
 
         message("Bedgraph written to {}".format(bedgraph_fp))
\ No newline at end of file
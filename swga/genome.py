@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""genome.py
+
+A 2-bit packed, memory-mapped copy of a genome (FASTA file).
+
+The packed copy is made once (by `swga init`, or the first time the genome is
+opened) and stored next to the FASTA file, or in the workspace (the current
+directory) if the FASTA file's directory isn't writable. Since it's
+memory-mapped, any number of processes can read the same genome
+from one page-cached copy instead of each holding its own Python strings.
+
+Anything other than an upper-case A, C, G or T (e.g. N or soft-masked bases)
+is recorded as an "invalid" block, so that locating primers in the packed
+genome gives the same results as searching the original sequence.
+"""
+from __future__ import division
+import hashlib
+import itertools
+import json
+import os
+import struct
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+MAGIC = b'SWGA2BIT'
+FORMAT_VERSION = 1
+# Not UCSC's .2bit format, so it doesn't use that extension
+EXTENSION = '.swga2bit'
+
+# Maps ASCII bytes to 2-bit base codes; anything but ACGT is 4 (invalid)
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    BASE_CODES[ord(_base)] = _code
+_ALPHABET = np.frombuffer(b"ACGTN", dtype=np.uint8)
+
+# Bit offsets of the four bases packed into each byte
+_SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+# Number of bases read from the FASTA file at a time when packing
+_PACK_CHUNK = 1 << 24
+
+
+def packed_fp(fasta_fp):
+    """Return where to write the packed copy of a FASTA file.
+
+    This is next to the FASTA file if its directory is writable, and in the
+    workspace (the current directory) otherwise.
+    """
+    fasta_dir = os.path.dirname(os.path.abspath(fasta_fp))
+    if os.access(fasta_dir, os.W_OK):
+        return fasta_fp + EXTENSION
+    return _workspace_packed_fp(fasta_fp)
+
+
+def _workspace_packed_fp(fasta_fp):
+    # The path is hashed so that FASTA files with the same name in different
+    # directories don't share a packed copy
+    digest = hashlib.sha1(os.path.abspath(fasta_fp)).hexdigest()[:8]
+    return os.path.join(
+        os.getcwd(),
+        '{}.{}{}'.format(os.path.basename(fasta_fp), digest, EXTENSION))
+
+
+class Genome(object):
+
+    """A 2-bit packed genome, read through a memory map."""
+
+    @staticmethod
+    def open(fasta_fp):
+        """Open the packed copy of a FASTA file, packing it first if needed.
+
+        The packed copy is rebuilt if the FASTA file has changed since it was
+        made.
+        """
+        for fp in (fasta_fp + EXTENSION, _workspace_packed_fp(fasta_fp)):
+            if os.path.isfile(fp):
+                genome = Genome(fp)
+                if genome.is_current(fasta_fp):
+                    return genome
+        fp = packed_fp(fasta_fp)
+        pack(fasta_fp, fp)
+        return Genome(fp)
+
+    def __init__(self, fp):
+        """Memory-map a packed genome.
+
+        :param fp: the path to the packed genome file
+        """
+        self.fp = fp
+        self._data = np.memmap(fp, dtype=np.uint8, mode='r')
+        if self._data[:len(MAGIC)].tostring() != MAGIC:
+            raise ValueError("{} is not a packed genome".format(fp))
+        header_len = struct.unpack(
+            '<Q', self._data[len(MAGIC):len(MAGIC) + 8].tostring())[0]
+        start = len(MAGIC) + 8
+        self.header = json.loads(
+            self._data[start:start + header_len].tostring())
+        self._data_start = start + header_len
+        self.records = OrderedDict(
+            (record['name'], record) for record in self.header['records'])
+
+    def is_current(self, fasta_fp):
+        """Check that the packed genome was made from this FASTA file."""
+        st = os.stat(fasta_fp)
+        return (self.header['version'] == FORMAT_VERSION and
+                self.header['source_size'] == st.st_size and
+                self.header['source_mtime'] == st.st_mtime)
+
+    def keys(self):
+        """Return the record names, in the order they appear in the FASTA."""
+        return list(self.records.keys())
+
+    def __len__(self):
+        """Return the total number of bases in the genome."""
+        return sum(record['length'] for record in self.records.values())
+
+    def record_length(self, record):
+        return self.records[record]['length']
+
+    def codes(self, record, start=0, end=None):
+        """Return the bases in a region of a record as 2-bit codes.
+
+        Bases are coded as A=0, C=1, G=2, T=3; anything else is 4.
+
+        :param record: the record name
+        :param start: the first position (0-based)
+        :param end: the position after the last (defaults to the record end)
+        :returns: a uint8 array of codes
+        """
+        rec = self.records[record]
+        end = rec['length'] if end is None else min(end, rec['length'])
+        start = max(0, min(start, end))
+        first, last = start // 4, (end + 3) // 4
+        offset = self._data_start + rec['offset']
+        packed = self._data[offset + first:offset + last]
+        codes = (packed[:, None] >> _SHIFTS) & np.uint8(3)
+        codes = codes.ravel()[start - first * 4:end - first * 4]
+
+        blocks = self._blocks(record)
+        # Blocks that overlap the region
+        lo = np.searchsorted(blocks[:, 1], start, side='right')
+        hi = np.searchsorted(blocks[:, 0], end, side='left')
+        for block_start, block_end in blocks[lo:hi]:
+            codes[max(block_start, start) - start:
+                  min(block_end, end) - start] = 4
+        return codes
+
+    def sequence(self, record, start=0, end=None):
+        """Return a region of a record as a string (invalid bases are 'N')."""
+        return _ALPHABET[self.codes(record, start, end)].tostring()
+
+    def _blocks(self, record):
+        rec = self.records[record]
+        offset = self._data_start + rec['blocks_offset']
+        n = rec['nblocks']
+        return self._data[offset:offset + n * 16].view('<i8').reshape(n, 2)
+
+
+def pack(fasta_fp, out_fp):
+    """Write a 2-bit packed copy of a FASTA file.
+
+    The file starts with a JSON header describing each record, followed by
+    the packed bases and invalid blocks of each record. Offsets in the header
+    are relative to the end of the header.
+
+    :param fasta_fp: the path to the FASTA file
+    :param out_fp: where to write the packed genome
+    """
+    st = os.stat(fasta_fp)
+    out_dir = os.path.dirname(os.path.abspath(out_fp))
+    records = []
+    # The records are packed to a temporary file first, since the header
+    # (which comes first) isn't known until they're all done
+    with tempfile.TemporaryFile(dir=out_dir) as data:
+        for name, chunks in _read_records(fasta_fp):
+            length = 0
+            offset = data.tell()
+            blocks = []
+            for seq in chunks:
+                codes = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+                blocks.append(_invalid_blocks(codes) + length)
+                data.write(_pack_codes(codes).tostring())
+                length += len(seq)
+            blocks = _merge_blocks(blocks)
+            blocks_offset = data.tell()
+            data.write(blocks.astype('<i8').tostring())
+            records.append({
+                'name': name,
+                'length': length,
+                'offset': offset,
+                'blocks_offset': blocks_offset,
+                'nblocks': len(blocks)})
+
+        header = json.dumps({
+            'version': FORMAT_VERSION,
+            'source_size': st.st_size,
+            'source_mtime': st.st_mtime,
+            'records': records})
+        # Pad the header so the packed data starts 8-byte aligned
+        header += ' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        # Written under a temporary name so other processes never open a
+        # partial file
+        out_fd, tmp_fp = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+        try:
+            with os.fdopen(out_fd, 'wb') as out:
+                out.write(MAGIC)
+                out.write(struct.pack('<Q', len(header)))
+                out.write(header)
+                data.seek(0)
+                for block in iter(lambda: data.read(1 << 20), b''):
+                    out.write(block)
+            os.rename(tmp_fp, out_fp)
+        except:
+            if os.path.isfile(tmp_fp):
+                os.remove(tmp_fp)
+            raise
+
+
+def _read_records(fasta_fp):
+    """Read the records of a FASTA file in one pass.
+
+    Yields the name of each record (its header, up to the first whitespace)
+    and an iterator over its sequence, `_PACK_CHUNK` bases at a time. Each
+    record's sequence must be read before moving on to the next record.
+    """
+    names = set()
+
+    def record(header):
+        name = header[1:].split(None, 1)[0] if header[1:].strip() else ''
+        if name in names:
+            raise ValueError(
+                "Duplicate record {} in {}".format(name, fasta_fp))
+        names.add(name)
+        return name
+
+    with open(fasta_fp, 'rb') as fasta:
+        name = None
+        lines = itertools.groupby(fasta, lambda line: line.startswith('>'))
+        for is_header, group in lines:
+            if is_header:
+                headers = list(group)
+                # Headers with no sequence lines after them are empty records
+                for header in headers[:-1]:
+                    yield record(header), iter(())
+                name = record(headers[-1])
+            elif name is not None:
+                yield name, _chunks(group)
+                name = None
+        if name is not None:
+            yield name, iter(())
+
+
+def _chunks(lines):
+    """Join lines of sequence and split them into `_PACK_CHUNK`-base chunks."""
+    buf = bytearray()
+    for line in lines:
+        buf += line.rstrip()
+        while len(buf) >= _PACK_CHUNK:
+            yield bytes(buf[:_PACK_CHUNK])
+            del buf[:_PACK_CHUNK]
+    if buf:
+        yield bytes(buf)
+
+
+def _pack_codes(codes):
+    """Pack 2-bit codes four to a byte (the first base in the high bits)."""
+    padded = np.zeros(len(codes) + (-len(codes) % 4), dtype=np.uint8)
+    padded[:len(codes)] = codes & 3
+    padded = padded.reshape(-1, 4) << _SHIFTS
+    return np.bitwise_or.reduce(padded, axis=1).astype(np.uint8)
+
+
+def _invalid_blocks(codes):
+    """Return the [start, end) intervals of invalid bases as an n x 2 array."""
+    invalid = np.concatenate(([False], codes > 3, [False]))
+    edges = np.flatnonzero(invalid[1:] != invalid[:-1])
+    return edges.reshape(-1, 2).astype(np.int64)
+
+
+def _merge_blocks(blocks):
+    """Join lists of blocks, merging blocks that touch across chunks."""
+    blocks = np.concatenate(blocks) if blocks else np.zeros((0, 2), np.int64)
+    if len(blocks) < 2:
+        return blocks.reshape(-1, 2)
+    touching = blocks[1:, 0] == blocks[:-1, 1]
+    starts = blocks[np.concatenate(([True], ~touching)), 0]
+    ends = blocks[np.concatenate((~touching, [True])), 1]
+    return np.column_stack((starts, ends))
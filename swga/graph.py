@@ -1,20 +1,72 @@
-import itertools
-from swga.kmers import max_sequential_nt
+import hashlib
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from swga.kmers import pairwise_max_sequential_nt
 from swga import (error, message)
 from swga.primers import Primers
+from swga.dimers import DimerTable
+from swga.workspace import _db, _graph_cache
 
 
-def build_edges(starting_primers, max_binding):
+def build_edges(starting_primers, max_binding, binding=None):
     '''
     Adds a primer pair to the list of edges if it passes the heterodimer
     filter using the max_binding cutoff.
+
+    :param binding: the heterodimer lengths between the primers (see
+    compatibility_matrix)
+    '''
+    primers = list(starting_primers)
+    compatible = compatibility_matrix(
+        [p.seq for p in primers], max_binding, binding)
+    return _edges(primers, compatible)
+
+
+def compatibility_matrix(seqs, max_binding, binding=None):
+    '''Returns which pairs of primers can be in the same set.
+
+    A pair is compatible if neither is a substring of the other and they
+    don't form heterodimers longer than max_binding.
+
+    :param seqs: the primer sequences
+    :param max_binding: the longest allowed heterodimer
+    :param binding: an n x n array of the heterodimer lengths between seqs,
+    such as a DimerTable's matrix; computed if not given
+    :returns: an n x n boolean array, where [i, j] is True if seqs[i] and
+    seqs[j] are compatible
     '''
-    edges = []
-    for p1, p2 in itertools.combinations(starting_primers, 2):
-        if (p1.seq not in p2.seq) and (p2.seq not in p1.seq):
-            if max_sequential_nt(p1.seq, p2.seq) <= max_binding:
-                edges.append([p1._id, p2._id])
-    return edges
+    if binding is None:
+        binding = pairwise_max_sequential_nt(seqs)
+    compatible = binding <= max_binding
+    for i, j in _substring_pairs(seqs):
+        compatible[i, j] = compatible[j, i] = False
+    return compatible
+
+
+def _edges(primers, compatible):
+    # Row-major order of the upper triangle is the same order as
+    # itertools.combinations
+    firsts, seconds = np.nonzero(np.triu(compatible, k=1))
+    ids = np.array([p._id for p in primers], dtype=object)
+    return np.column_stack((ids[firsts], ids[seconds])).tolist()
+
+
+def _substring_pairs(seqs):
+    '''Yields (i, j) for each pair where seqs[j] is a substring of seqs[i].'''
+    index = defaultdict(list)
+    for i, seq in enumerate(seqs):
+        index[seq].append(i)
+    for i, seq in enumerate(seqs):
+        substrings = set(
+            seq[start:end] for start in xrange(len(seq))
+            for end in xrange(start + 1, len(seq) + 1))
+        for substring in substrings:
+            for j in index.get(substring, []):
+                if i != j:
+                    yield i, j
 
 
 def write_graph(primers, edges, file_handle):
@@ -42,14 +94,60 @@ def write_graph(primers, edges, file_handle):
                              "two elements. Invalid edge: {}".format(edge))
 
 
+def graph_key(primers, max_hetdimer_bind):
+    '''Returns a hash of everything that goes into a compatibility graph.'''
+    key = hashlib.sha1(str(max_hetdimer_bind))
+    for primer in primers:
+        key.update("\n{} {} {}".format(primer._id, primer.seq, primer.bg_freq))
+    return key.hexdigest()
+
+
+def load_cache():
+    '''Returns the cached compatibility graph, or None if there isn't one.'''
+    # Workspaces made by older versions of swga don't have the table yet
+    _graph_cache.create_table(fail_silently=True)
+    return _graph_cache.select().first()
+
+
+def save_cache(key, outfile):
+    '''Records the graph file that was just written.'''
+    st = os.stat(outfile)
+    with _db.atomic():
+        _graph_cache.delete().execute()
+        _graph_cache.create(
+            key=key, graph_size=st.st_size, graph_mtime=st.st_mtime)
+
+
+def _is_current(cache, key, outfile):
+    if cache is None or cache.key != key or not os.path.isfile(outfile):
+        return False
+    st = os.stat(outfile)
+    return (st.st_size == cache.graph_size and
+            st.st_mtime == cache.graph_mtime)
+
+
 def build_graph(max_hetdimer_bind, outfile):
-    '''Selects all active primers and outputs a primer compatibility graph.'''
+    '''Selects all active primers and outputs a primer compatibility graph.
+
+    If the active primers (and their ids and weights) and max_hetdimer_bind
+    haven't changed since the graph was written, the graph file is left as it
+    is. Heterodimers are looked up in the workspace's DimerTable, so only
+    primers that haven't been seen before are aligned.
+    '''
 
     # Reset all the primer IDs (as ids are only used for set_finder)
-    primers = Primers.select_active().assign_ids()
-#    print [(p._id, p.ratio) for p in primers]
+    primers = list(Primers.select_active().assign_ids())
+    key = graph_key(primers, max_hetdimer_bind)
+    cache = load_cache()
+    if _is_current(cache, key, outfile):
+        message("Using cached primer compatibility graph.")
+        return
+
     message("Composing primer compatibility graph...")
-    edges = build_edges(primers, max_hetdimer_bind)
+    seqs = [p.seq for p in primers]
+    compatible = compatibility_matrix(
+        seqs, max_hetdimer_bind, DimerTable(seqs).matrix)
+    edges = _edges(primers, compatible)
 
     if len(edges) == 0:
         error(
@@ -58,3 +156,4 @@ def build_graph(max_hetdimer_bind, outfile):
 
     with open(outfile, 'wb') as out:
         write_graph(primers, edges, out)
+    save_cache(key, outfile)
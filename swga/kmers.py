@@ -2,11 +2,15 @@
 '''Functions for counting/reading raw k-mer sequences.'''
 from __future__ import with_statement, division
 import subprocess
+import hashlib
 import os
 import re
-import struct
+import tempfile
+import zipfile
 
-from swga import message
+import numpy as np
+
+from swga import message, warn
 #from swga.utils import dsk
 import swga.utils
 
@@ -20,19 +24,30 @@ def parse_kmer_file(lines):
     return seqs
 
 
-def count_kmers(k, genome_fp, cwd, threshold=1):
+def count_kmers(k, genome_fp, cwd, threshold=1, cache=None):
     '''Counts k-mers in the specified genome.
 
     :param k: the number of nucleotides in the k-mers
     :param genome_fp: the file path to the genome/fasta file
     :param cwd: the current working directory (to store intermediate cache)
     :param threshold: the minimum k-mer frequency
+    :param cache: a KmerCache to reuse counts from (or None to always count)
+    :returns: a KmerTable of the k-mers appearing >= threshold times
     '''
 
     assert isinstance(threshold, int)
 
+    if cache is not None:
+        kmers = cache.get(genome_fp, k, threshold)
+        if kmers is not None:
+            message("Using cached %d-mer counts for %s" % (k, genome_fp))
+            return kmers
+
+    # The checksum and threshold keep genomes with the same name (or counts
+    # made with a different threshold) from sharing the same output file
     genome = genome_fp.split(os.sep).pop()
-    out = '%s-%dmers' % (genome, k)
+    out = '%s-%s-%dmers-t%d' % (
+        genome, genome_checksum(genome_fp)[:12], k, threshold)
     outfile = os.path.join(cwd, out + '.solid_kmers_binary')
 
     if os.path.isfile(outfile):
@@ -49,11 +64,192 @@ def count_kmers(k, genome_fp, cwd, threshold=1):
                 os.remove(outfile)
             raise
 
-    primers = dict((kmer, freq)
-                   for kmer, freq in _parse_kmer_binary(outfile)
-                   if freq >= threshold)
+    k, kmers, freqs = read_kmer_binary(outfile)
+    passing = freqs >= threshold
+    kmers = KmerTable(k, kmers[passing], freqs[passing])
+
+    # DSK's output is no longer needed once the counts are in the cache
+    if cache is not None:
+        cache.put(genome_fp, k, threshold, kmers)
+        for intermediate in (outfile, os.path.join(cwd, out + '.reads_binary')):
+            if os.path.isfile(intermediate):
+                os.remove(intermediate)
+
+    return kmers
+
+
+def genome_checksum(genome_fp, _checksums={}):
+    '''Returns the SHA1 checksum of a genome file's contents.
+
+    Checksums are remembered for as long as the file's size and modification
+    time stay the same, so repeat calls do not re-read large genomes.
+    '''
+    genome_fp = os.path.abspath(genome_fp)
+    st = os.stat(genome_fp)
+    key = (genome_fp, st.st_size, st.st_mtime)
+    if key not in _checksums:
+        sha1 = hashlib.sha1()
+        with open(genome_fp, 'rb') as genome:
+            for block in iter(lambda: genome.read(1 << 20), b''):
+                sha1.update(block)
+        _checksums[key] = sha1.hexdigest()
+    return _checksums[key]
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+class KmerCache(object):
+
+    '''A content-addressed store of k-mer counts shared between workspaces.
+
+    Each entry holds the KmerTable for one genome, k and threshold, keyed by
+    the checksum of the genome file so that renamed or moved genomes still hit
+    the cache and different genomes with the same name do not collide. When the
+    cache grows larger than `max_size` bytes, the least recently used entries
+    are removed.
+    '''
+
+    def __init__(self, path, max_size):
+        '''Open (or create) a k-mer cache in the given directory.
+
+        :param path: the cache directory
+        :param max_size: the max size of the cache in bytes
+        '''
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        swga.utils.mkdirp(self.path)
+
+    def entry(self, genome_fp, k, threshold):
+        '''Return the path to the cache entry for these counts.'''
+        fname = '%s-k%d-t%d.npz' % (genome_checksum(genome_fp), k, threshold)
+        return os.path.join(self.path, fname)
+
+    def get(self, genome_fp, k, threshold):
+        '''Return the cached KmerTable for these counts, or None.'''
+        fp = self.entry(genome_fp, k, threshold)
+        if not os.path.isfile(fp):
+            return None
+        try:
+            with open(fp, 'rb') as entry:
+                data = np.load(entry)
+                kmers = KmerTable(
+                    int(data['k']), data['kmers'], data['counts'],
+                    presorted=True)
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile) as e:
+            # A damaged entry is counted again (and replaced)
+            warn("Ignoring unreadable k-mer cache entry {}: {}".format(fp, e))
+            return None
+        # Mark as recently used
+        os.utime(fp, None)
+        return kmers
+
+    def put(self, genome_fp, k, threshold, kmers):
+        '''Store a KmerTable in the cache and evict entries if needed.'''
+        fp = self.entry(genome_fp, k, threshold)
+        # Written to a temporary file first so that other workspaces never
+        # see a partial entry
+        fd, tmp_fp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                np.savez(tmp, k=kmers.k, kmers=kmers.kmers,
+                         counts=kmers.counts)
+            # mkstemp makes files only the owner can read; entries get the
+            # usual permissions so the cache can be shared
+            os.chmod(tmp_fp, 0o666 & ~_umask())
+            os.rename(tmp_fp, fp)
+        except:
+            if os.path.isfile(tmp_fp):
+                os.remove(tmp_fp)
+            raise
+        self.evict(keep=fp)
+
+    def evict(self, keep=None):
+        '''Remove least recently used entries until the cache fits.
+
+        :param keep: an entry that should not be removed
+        '''
+        entries = []
+        for fname in os.listdir(self.path):
+            fp = os.path.join(self.path, fname)
+            if fname.endswith('.npz') and os.path.isfile(fp):
+                st = os.stat(fp)
+                entries.append((st.st_mtime, st.st_size, fp))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, fp in entries:
+            if total <= self.max_size:
+                break
+            if fp == keep:
+                continue
+            try:
+                os.remove(fp)
+            except OSError:
+                pass
+            total -= size
+
+
+class KmerTable(object):
+
+    '''A compact, sorted table of k-mer counts.
+
+    K-mers are stored 2-bit packed (in the same encoding DSK uses) as a sorted
+    uint64 array, with their counts in a parallel uint32 array. Membership and
+    lookups are vectorized binary searches over the packed keys.
+    '''
+
+    def __init__(self, k, kmers=(), counts=(), presorted=False):
+        '''Create a new table of k-mer counts.
+
+        :param k: the number of nucleotides in the k-mers
+        :param kmers: the packed k-mers (need not be sorted)
+        :param counts: the number of times each k-mer appears
+        :param presorted: if True, the k-mers are already in sorted order
+        '''
+        kmers = np.asarray(kmers, dtype=np.uint64)
+        counts = np.asarray(counts, dtype=np.uint32)
+        if kmers.shape != counts.shape:
+            raise ValueError("Must have one count per k-mer.")
+        if not presorted:
+            order = np.argsort(kmers, kind='mergesort')
+            kmers = kmers[order]
+            counts = counts[order]
+        self.k = k
+        self.kmers = kmers
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.kmers)
+
+    def __contains__(self, seq):
+        kmers, valid = encode_kmers([seq], self.k)
+        return bool(valid[0] and self.contains(kmers)[0])
 
-    return primers
+    def _search(self, kmers):
+        kmers = np.asarray(kmers, dtype=np.uint64)
+        idx = np.searchsorted(self.kmers, kmers)
+        idx[idx == len(self.kmers)] = 0
+        found = (self.kmers[idx] == kmers) if len(self.kmers) else (
+            np.zeros(len(kmers), dtype=bool))
+        return idx, found
+
+    def contains(self, kmers):
+        '''Return a boolean array marking which packed k-mers are present.'''
+        return self._search(kmers)[1]
+
+    def lookup(self, kmers, default=0):
+        '''Return the counts for the packed k-mers, or `default` if absent.'''
+        idx, found = self._search(kmers)
+        counts = np.full(len(found), default, dtype=np.uint32)
+        counts[found] = self.counts[idx[found]]
+        return counts
+
+    def seqs(self):
+        '''Return the k-mers in the table as strings.'''
+        return decode_kmers(self.kmers, self.k)
 
 
 def max_sequential_nt(mer1, mer2):
@@ -91,25 +287,187 @@ def max_sequential_nt(mer1, mer2):
     return max_bind
 
 
-def _parse_kmer_binary(fp):
-    # Adapted from `dsk/parse_results.py`
-    with open(fp, 'rb') as f:
-        try:
-            kmer_nbits = struct.unpack('i', f.read(4))[0]
-            k = struct.unpack('i', f.read(4))[0]
-        except struct.error:
-            if os.path.isfile(fp):
-                os.remove(fp)
-            raise
-        try:
-            while True:
-                kmer_binary = struct.unpack('B' * (kmer_nbits // 8),
-                                            f.read(kmer_nbits // 8))
-                freq = struct.unpack('I', f.read(4))[0]
-                kmer = ""
-                for i in xrange(k):
-                    kmer = "ACTG"[
-                        (kmer_binary[i // 4] >> (2 * (i % 4))) % 4] + kmer
-                yield kmer, freq
-        except struct.error:
-            pass
+def pairwise_max_sequential_nt(seqs, others=None, blocksize=256):
+    '''Returns max_sequential_nt for every pair of kmers at once.
+
+    Each kmer is encoded once as 64-bit bitplanes (one bit per base), so that
+    every alignment of a pair can be tested with a handful of bitwise
+    operations. The longest run of complementary bases is then found by
+    repeatedly and-ing the match bits with themselves shifted by one. Kmers
+    are compared in blocks of rows to bound memory use.
+
+    :param seqs: a list of kmers (at most 32 nt long)
+    :param others: if given, seqs are compared against these kmers instead of
+    against each other
+    :param blocksize: the number of kmers compared against all others at once
+    :returns: a symmetric n x n uint8 array, where [i, j] is equal to
+    max_sequential_nt(seqs[i], seqs[j]); or, if others is given, an
+    n x len(others) array, where [i, j] is max_sequential_nt(seqs[i], others[j])
+    '''
+    square = others is None
+    others = seqs if square else others
+    result = np.zeros((len(seqs), len(others)), dtype=np.uint8)
+    if result.size == 0:
+        return result
+    lengths1 = np.array([len(seq) for seq in seqs])
+    lengths2 = np.array([len(seq) for seq in others])
+    if max(lengths1.max(), lengths2.max()) > 32:
+        raise ValueError("Kmers longer than 32 nt are not supported.")
+
+    fwd = _bitplanes(seqs, lengths1)
+    rev = _bitplanes(others, lengths2, reverse=True)
+    # Matches for one alignment only occupy the first len(kmer) bits, so the
+    # matches for several alignments are packed into one word (with a zero bit
+    # between each) and their longest runs found together
+    slot_width = lengths1.max() + 1
+    slots = 64 // slot_width
+
+    for start in xrange(0, len(seqs), blocksize):
+        rows = slice(start, min(start + blocksize, len(seqs)))
+        # A symmetric result only needs its upper triangle computed
+        cols = slice(start if square else 0, None)
+        len1 = lengths1[rows][:, None]
+        len2 = lengths2[None, cols]
+        # max_sequential_nt only slides the (reversed) second kmer to the
+        # right of the start of the first, once the longer kmer is first
+        min_shift = np.minimum(len1, len2) - len2
+        lo1, hi1, ok1 = [plane[rows][:, None] for plane in fwd]
+        best = np.zeros((len1.shape[0], len2.shape[1]), dtype=np.uint8)
+        shifts = range(min_shift.min(), len1.max())
+        for first in xrange(0, len(shifts), slots):
+            packed = np.zeros(best.shape, dtype=np.uint64)
+            for slot, shift in enumerate(shifts[first:first + slots]):
+                lo2, hi2, ok2 = [
+                    (plane[cols] << np.uint64(shift) if shift >= 0 else
+                     plane[cols] >> np.uint64(-shift))[None, :]
+                    for plane in rev]
+                # Complementary bases differ in both bits (see _bitplanes)
+                matches = ok1 & ok2 & (lo1 ^ lo2) & (hi1 ^ hi2)
+                if shift < 0:
+                    matches[min_shift > shift] = 0
+                packed |= matches << np.uint64(slot * slot_width)
+            np.maximum(best, _longest_runs(packed), out=best)
+        result[rows, cols] = best
+
+    return np.maximum(result, result.T) if square else result
+
+
+def _bitplanes(seqs, lengths, reverse=False):
+    '''Encodes kmers as three uint64 bitplanes, with base i stored at bit i.
+
+    Bases are coded so that complementary bases differ in both bits
+    (A=00, C=01, G=10, T=11); the third plane marks valid (ACGT) bases.
+    '''
+    codes = np.full(256, 4, dtype=np.uint64)
+    for i, base in enumerate("ACGT"):
+        codes[ord(base)] = i
+    chars = np.array([str(seq) for seq in seqs], dtype='S32')
+    bases = codes[chars.view(np.uint8).reshape(-1, 32)]
+    if reverse:
+        idx = lengths[:, None] - 1 - np.arange(32)
+        bases = np.where(
+            idx >= 0,
+            bases[np.arange(len(seqs))[:, None], np.maximum(idx, 0)],
+            4)
+    valid = bases < 4
+    bits = np.uint64(1) << np.arange(32, dtype=np.uint64)
+    lo = ((bases & np.uint64(1)) * bits) * valid
+    hi = (((bases >> np.uint64(1)) & np.uint64(1)) * bits) * valid
+    return (
+        np.bitwise_or.reduce(lo.astype(np.uint64), axis=1),
+        np.bitwise_or.reduce(hi.astype(np.uint64), axis=1),
+        np.bitwise_or.reduce((valid * bits).astype(np.uint64), axis=1))
+
+
+def _longest_runs(bits):
+    '''Returns the length of the longest run of set bits in each element.'''
+    runs = np.zeros(bits.shape, dtype=np.uint8)
+    one = np.uint64(1)
+    while True:
+        nonzero = bits != 0
+        if not nonzero.any():
+            return runs
+        runs += nonzero
+        bits = bits & (bits >> one)
+
+
+def read_kmer_binary(fp):
+    '''Reads a DSK `.solid_kmers_binary` file into packed arrays.
+
+    The file is memory-mapped and read as fixed-width records, so no per-kmer
+    Python objects are created. K-mers are returned in the 2-bit packed form
+    DSK uses (see `decode_kmers` to turn them into strings).
+
+    :param fp: the path to the binary file
+    :returns: (k, kmers, freqs) where kmers is a uint64 array and freqs is a
+    uint32 array of the same length
+    '''
+    header = np.fromfile(fp, dtype='<i4', count=2)
+    if len(header) < 2:
+        if os.path.isfile(fp):
+            os.remove(fp)
+        raise ValueError("Truncated or empty kmer file: %s" % fp)
+    kmer_nbits, k = (int(_) for _ in header)
+    kmer_nbytes = kmer_nbits // 8
+    if k > 32 or kmer_nbytes < 8:
+        raise ValueError(
+            "Cannot read %d-mers stored in %d bits from %s"
+            % (k, kmer_nbits, fp))
+
+    # Only the low 64 bits of the k-mer are needed for k <= 32; any extra
+    # bytes (from a DSK compiled with larger k-mers) are skipped
+    fields = [('kmer', '<u8')]
+    if kmer_nbytes > 8:
+        fields.append(('pad', 'V%d' % (kmer_nbytes - 8)))
+    fields.append(('freq', '<u4'))
+    dtype = np.dtype(fields)
+
+    # Ignores any partial record at the end of the file
+    nrecords = (os.path.getsize(fp) - header.nbytes) // dtype.itemsize
+    if nrecords == 0:
+        return k, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32)
+    records = np.memmap(
+        fp, dtype=dtype, mode='r', offset=header.nbytes, shape=(nrecords,))
+    return k, records['kmer'], records['freq']
+
+
+def encode_kmers(seqs, k):
+    '''Packs k-mer strings into 2-bit integers (the inverse of decode_kmers).
+
+    :param seqs: a list of k-mer strings, all of length k
+    :param k: the number of nucleotides in each k-mer
+    :returns: (kmers, valid) where kmers is a uint64 array and valid marks the
+    sequences that were k nucleotides long and only contained A, C, G or T
+    '''
+    codes = np.full(256, 4, dtype=np.uint64)
+    for i, base in enumerate("ACTG"):
+        codes[ord(base)] = i
+    seqs = [str(seq) for seq in seqs]
+    chars = np.array(seqs, dtype='S%d' % k).view(np.uint8).reshape(-1, k)
+    bases = codes[chars]
+    valid = ((bases < 4).all(axis=1) &
+             np.array([len(seq) == k for seq in seqs], dtype=bool))
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    kmers = np.bitwise_or.reduce(
+        (bases & np.uint64(3)) << shifts, axis=1).astype(np.uint64)
+    return kmers, valid
+
+
+def decode_kmers(kmers, k, chunksize=1 << 20):
+    '''Converts 2-bit packed k-mers (as stored by DSK) to strings.
+
+    :param kmers: an array of packed k-mers
+    :param k: the number of nucleotides in each k-mer
+    :param chunksize: the number of k-mers to decode at a time
+    :returns: a list of k-mer strings
+    '''
+    alphabet = np.frombuffer(b"ACTG", dtype=np.uint8)
+    # The first base of the k-mer is stored in the most significant bits
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    seqs = []
+    for start in xrange(0, len(kmers), chunksize):
+        chunk = np.asarray(kmers[start:start + chunksize], dtype=np.uint64)
+        codes = (chunk[:, None] >> shifts) & np.uint64(3)
+        chars = np.ascontiguousarray(alphabet[codes])
+        seqs += chars.view('S%d' % k).ravel().tolist()
+    return seqs
@@ -5,8 +5,19 @@ This module contains functions for locating primers in genomes (i.e. finding
 small substrings in larger strings).
 
 """
-import json
-from pyfaidx import Fasta
+import multiprocessing
+import os
+from collections import defaultdict
+
+import numpy as np
+
+from swga.genome import Genome, BASE_CODES
+
+# Length of the genome segments each worker scans at a time
+CHUNK_SIZE = 1 << 22
+
+# The chromosome_ends of each genome used so far, by (path, size, mtime)
+_chr_ends = {}
 
 
 def revcomp(s):
@@ -24,36 +35,236 @@ def linearize_binding_sites(primers, chr_ends):
     Modifies the primer binding site locations as if they were positions on a
     linear genome composed of all the chromosomes concatenated together. This
     allows us to compute distances between primer binding sites correctly.
+
+    Returns the sorted, unique sites, including the start and end of every
+    chromosome.
+    '''
+    return merge_sites(
+        [primer.linear_locations for primer in primers], chr_ends).tolist()
+
+
+def merge_sites(sites, chr_ends):
+    '''
+    Merges arrays of linearized binding sites into a sorted array of unique
+    sites, including the start and end of every chromosome.
     '''
-    new_locs = []
-    for primer in primers:
-        for rec, locs in primer.locations.iteritems():
-            chr_start, chr_end = chr_ends[rec]
-            new_locs += [l + chr_start for l in locs] + [chr_start, chr_end]
-    new_locs = list(set(new_locs))
-    if new_locs == []:
+    if len(sites) == 0:
         raise ValueError("Binding sites for primers not found!")
-    return list(set(new_locs))
+    sites = list(sites)
+    sites.append(np.array(chr_ends.values(), dtype=np.int64).ravel())
+    return np.unique(np.concatenate(sites))
+
+
+class LocationCache(object):
+    '''
+    Holds the linearized binding sites of a group of primers (e.g. all the
+    active primers) in a single array, so the sites of any subset of them can
+    be looked up by primer id without going back to the database.
+
+    Primers are looked up by the attribute named by `key` (their id, or e.g.
+    'seq' for primers that might not have ids).
+    '''
+
+    def __init__(self, primers, key='_id'):
+        primers = list(primers)
+        sites = [primer.linear_locations for primer in primers]
+        offsets = np.cumsum([0] + [len(s) for s in sites])
+        self._sites = (
+            np.concatenate(sites) if sites else np.zeros(0, dtype=np.int64))
+        self._slices = {
+            getattr(primer, key): (offsets[i], offsets[i + 1])
+            for i, primer in enumerate(primers)}
+        self._primers = {getattr(primer, key): primer for primer in primers}
+
+    def __len__(self):
+        return len(self._primers)
+
+    def __contains__(self, _id):
+        return _id in self._primers
+
+    def primers(self, ids):
+        '''Returns the Primer objects with the given ids.'''
+        return [self._primers[_id] for _id in ids]
+
+    def sites(self, ids):
+        '''Returns the sorted binding sites of each primer (as array views).'''
+        return [self._sites[slice(*self._slices[_id])] for _id in ids]
+
+
+def pack_locations(locations, chr_ends):
+    '''
+    Packs binding sites (a dict of record name: [positions]) into a string of
+    sorted little-endian int64 positions on the linearized genome, for storage
+    in the workspace.
+    '''
+    sites = [
+        np.asarray(locs, dtype=np.int64) + chr_ends[rec][0]
+        for rec, locs in locations.iteritems()]
+    sites = np.sort(np.concatenate(sites)) if sites else np.zeros(0, np.int64)
+    return buffer(sites.astype('<i8').tostring())
+
+
+def unpack_locations(packed):
+    '''Reads packed binding sites back into an int64 array (not a copy).'''
+    return np.frombuffer(packed, dtype='<i8')
+
+
+def delinearize_binding_sites(sites, chr_ends):
+    '''
+    Splits sorted sites on the linearized genome back into a dict of record
+    name: [positions in that record], with an entry for every record.
+    '''
+    records = sorted(chr_ends, key=lambda rec: chr_ends[rec])
+    starts = np.array([chr_ends[rec][0] for rec in records], dtype=np.int64)
+    bounds = np.searchsorted(sites, starts)
+    bounds = np.append(bounds, len(sites))
+    return {
+        rec: (sites[bounds[i]:bounds[i + 1]] - starts[i]).tolist()
+        for i, rec in enumerate(records)}
 
 
 def binding_sites(kmer, genome_fp):
-    genome = Fasta(genome_fp)
-    locations = {}
-    kmer = str(kmer)
-    for record in genome.keys():
-        seq = str(genome[record])
-        locations[record] = substr_indices(kmer, seq)
-        # append reversed primer locations as well
-        locations[record] += substr_indices(revcomp(kmer), seq)
-    if locations == {}:
-        raise ValueError(
-            "No locations for {} found in fg genome!".format(kmer))
-    return locations
+    return multi_binding_sites([kmer], genome_fp)[0]
 
 
-def _primer_bind_sites(primer, genome_fp):
-    primer.locations = json.dumps(binding_sites(primer.seq, genome_fp))
-    return primer
+def multi_binding_sites(kmers, genome_fp, workers=1):
+    '''
+    Finds the binding sites of many kmers (and their reverse complements) at
+    once, in a single pass over each record in the genome.
+
+    Every window of the genome is 2-bit encoded and looked up in a sorted
+    table of the target kmers, so the cost of a pass barely depends on the
+    number of kmers. Records are split into chunks that can be scanned by a
+    pool of worker processes.
+
+    :param kmers: a list of kmer sequences
+    :param genome_fp: the path to the genome (FASTA format)
+    :param workers: the number of processes to scan the genome with
+    :returns: a list with a {record: [locations]} dict for each kmer, in the
+    same format as binding_sites
+    '''
+    kmers = [str(kmer) for kmer in kmers]
+    targets = set(kmers) | set(revcomp(kmer) for kmer in kmers)
+    genome = Genome.open(genome_fp)
+    records = genome.keys()
+    max_len = max(len(target) for target in targets) if targets else 1
+
+    tasks = [
+        (record, start,
+         min(start + CHUNK_SIZE, genome.record_length(record)))
+        for record in records
+        for start in xrange(0, genome.record_length(record), CHUNK_SIZE)]
+
+    # Workers each map the same packed genome rather than copying it
+    initargs = (genome.fp, targets, max_len)
+    if workers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_scanner, initargs=initargs)
+        try:
+            results = pool.map(_scan_chunk, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+    else:
+        _init_scanner(*initargs)
+        results = [_scan_chunk(task) for task in tasks]
+
+    # Chunks are in order, so each target's hits stay sorted
+    hits = dict((record, defaultdict(list)) for record in records)
+    for (record, _, _), chunk_hits in zip(tasks, results):
+        for target, positions in chunk_hits.iteritems():
+            hits[record][target] += positions
+
+    all_locations = []
+    for kmer in kmers:
+        locations = {}
+        for record in records:
+            locations[record] = list(hits[record].get(kmer.upper(), []))
+            # append reversed primer locations as well
+            locations[record] += hits[record].get(revcomp(kmer), [])
+        if locations == {}:
+            raise ValueError(
+                "No locations for {} found in fg genome!".format(kmer))
+        all_locations.append(locations)
+    return all_locations
+
+
+# Per-process state for _scan_chunk, set up by _init_scanner
+_scanner = {}
+
+
+def _init_scanner(packed_fp, targets, max_len):
+    '''Maps the packed genome and builds the lookup tables for the targets.'''
+    by_length = defaultdict(list)
+    unencodable = []
+    for target in sorted(set(target.upper() for target in targets)):
+        codes = BASE_CODES[np.frombuffer(target, dtype=np.uint8)]
+        if (codes < 4).all() and len(target) <= 32:
+            by_length[len(target)].append((_pack(codes), target))
+        else:
+            unencodable.append(target)
+    tables = {}
+    for length, packed in by_length.iteritems():
+        packed.sort()
+        tables[length] = (
+            np.array([p for p, _ in packed], dtype=np.uint64),
+            [target for _, target in packed])
+    _scanner.clear()
+    _scanner.update(
+        genome=Genome(packed_fp), tables=tables, unencodable=unencodable,
+        max_len=max_len)
+
+
+def _pack(codes):
+    packed = 0
+    for code in codes:
+        packed = (packed << 2) | int(code)
+    return packed
+
+
+def _scan_chunk(task):
+    '''Finds all target hits that start within a chunk of a record.
+
+    :param task: a (record, start, end) tuple
+    :returns: a dict of {target: [locations]}, in sorted order
+    '''
+    record, start, end = task
+    genome = _scanner['genome']
+    # Overlap the next chunk so hits spanning the boundary are found
+    codes = genome.codes(record, start, end + _scanner['max_len'] - 1)
+    # Number of invalid bases before each position
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    two = np.uint64(2)
+    hits = {}
+    for length, (packed, targets) in _scanner['tables'].iteritems():
+        n = min(end - start, len(codes) - length + 1)
+        if n <= 0:
+            continue
+        windows = np.zeros(n, dtype=np.uint64)
+        for i in xrange(length):
+            windows <<= two
+            windows |= codes[i:i + n]
+        valid = invalid[length:length + n] == invalid[:n]
+        idx = np.searchsorted(packed, windows)
+        idx[idx == len(packed)] = 0
+        found = np.flatnonzero(valid & (packed[idx] == windows))
+        which = idx[found]
+        order = np.argsort(which, kind='mergesort')
+        which = which[order]
+        found = found[order] + start
+        bounds = np.flatnonzero(np.diff(which)) + 1
+        for group in np.split(np.arange(len(which)), bounds):
+            if len(group):
+                hits[targets[which[group[0]]]] = found[group].tolist()
+    if _scanner['unencodable']:
+        seq = genome.sequence(
+            record, start, end + _scanner['max_len'] - 1)
+    for target in _scanner['unencodable']:
+        positions = [
+            p + start for p in substr_indices(target, seq)
+            if p < end - start]
+        if positions:
+            hits[target] = positions
+    return hits
 
 
 def chromosome_ends(genome_fp):
@@ -61,13 +272,62 @@ def chromosome_ends(genome_fp):
     Returns the locations of the starts/ends of each chromosome (record) in a
     genome where all the chromosomes are concatenated (so i.e. the 2nd genome
     start site is len(1st genome), and all indices are 0-based).
+
+    The records are only read from the genome the first time they're needed
+    (if they weren't cached from the workspace metadata already, see
+    cache_chromosome_ends). Every caller gets the same dict, so it must not
+    be modified. The genome is read again if its file has changed.
     '''
-    genome = Fasta(genome_fp)
+    key = _genome_key(genome_fp)
+    if key not in _chr_ends:
+        _chr_ends[key] = _layout_ends(record_layout(genome_fp))
+    return _chr_ends[key]
+
+
+def record_layout(genome_fp):
+    '''Returns the name and length of each record, in genome order.'''
+    genome = Genome.open(genome_fp)
+    return [[record, genome.record_length(record)] for record in genome.keys()]
+
+
+def genome_layout(genome_fp):
+    '''
+    Returns the record_layout of a genome along with the size and mtime of
+    its file (which tell if the layout is still current), for storing in the
+    workspace metadata.
+    '''
+    _, size, mtime = _genome_key(genome_fp)
+    return {'size': size, 'mtime': mtime, 'records': record_layout(genome_fp)}
+
+
+def is_current_layout(genome_fp, layout):
+    '''Checks that a genome_layout was made from the genome as it is now.'''
+    return (isinstance(layout, dict) and
+            (layout.get('size'), layout.get('mtime')) ==
+            _genome_key(genome_fp)[1:])
+
+
+def cache_chromosome_ends(genome_fp, layout):
+    '''
+    Caches the chromosome_ends of a genome from its genome_layout. The cached
+    ends are only used while the genome's file is unchanged.
+    '''
+    if not isinstance(layout, dict):
+        return
+    key = (os.path.abspath(genome_fp), layout['size'], layout['mtime'])
+    _chr_ends[key] = _layout_ends(layout['records'])
+
+
+def _genome_key(genome_fp):
+    '''Identifies a genome file as it is now: (path, size, mtime).'''
+    st = os.stat(genome_fp)
+    return os.path.abspath(genome_fp), st.st_size, st.st_mtime
+
+
+def _layout_ends(layout):
     len_so_far = 0
     chr_ends = {}
-    for record in genome.keys():
-        chromosome = genome[record]
-        chr_len = len(chromosome)
+    for record, chr_len in layout:
         chr_ends[record] = [len_so_far, chr_len + len_so_far - 1]
         len_so_far += chr_len
     return chr_ends
@@ -42,7 +42,11 @@ def setup_and_run(cmd_class, name, remaining_args):
     cfg_file = os.path.abspath(DEFAULT_CFG_FNAME)
     with workspace.connection(db_name) as ws:
         assert not ws.is_closed()
+        # Workspaces from incompatible versions are rejected before any
+        # changes are made to them
         ws.check_version(__version__)
+        ws.migrate_metadata()
+        ws.migrate_locations()
         metadata = ws.metadata
         cmd = cmd_class(name, cfg_file, metadata, ws)
         cmd.parse_args(remaining_args)
@@ -2,45 +2,55 @@
 Functions for handling lists of primers (filtering, updating, etc).
 '''
 
+import operator
 import re
+import time
 from functools import wraps
 
-from peewee import SelectQuery
+from peewee import fn
 
 from swga import (error, warn, message)
-from workspace import Primer
+from workspace import Primer, SQLITE_MAX_VARIABLES
 import locate
+import thermo
 import utils
 
+# The number of primers updated per executemany() call
+UPDATE_CHUNK = 5000
+
 
 def _filter(fn):
     """Wrapper for filter methods.
 
-    Updates the internal count of primers and ensures the statement
-    executes after each filter method.
+    Filter methods return a predicate on Primer and a description of the
+    primers that pass it. The predicates aren't run right away: they are
+    collected until the primers are next needed, then applied together in a
+    single query (see Primers._apply).
     """
     @wraps(fn)
     def func(self, *args, **kwargs):
-        results = fn(self, *args, **kwargs)
-        assert isinstance(results, SelectQuery)
-        self.primers = results
-        self._update_n()
+        predicate, description = fn(self, *args, **kwargs)
+        self._pending.append((predicate, description))
         return self
     return func
 
 
-def _update(fn):
+def _update(*fields):
     """Wrapper for update methods.
 
-    Updates the database in chunks after each update method.
+    Writes the given fields of the primers returned by the update method to
+    the database (see Primers._update_in_chunks).
     """
-    @wraps(fn)
-    def func(self, *args, **kwargs):
-        targets = fn(self, *args, **kwargs)
-        show_progress = len(targets) > 300
-        Primers._update_in_chunks(targets, show_progress=show_progress)
-        return self
-    return func
+    def decorator(fn):
+        @wraps(fn)
+        def func(self, *args, **kwargs):
+            targets = fn(self, *args, **kwargs)
+            show_progress = len(targets) > 300
+            Primers._update_in_chunks(
+                targets, fields, show_progress=show_progress)
+            return self
+        return func
+    return decorator
 
 
 class Primers(object):
@@ -80,73 +90,104 @@ class Primers(object):
                 p2['seq'] = locate.revcomp(p['seq'])
                 return p2
             primer_dicts += [mkrevcomp(p) for p in primer_dicts]
-        utils.chunk_iterator(
+        if not primer_dicts:
+            return
+        # Fields with defaults are inserted too, even if they aren't given
+        columns = set(primer_dicts[0]) | set(
+            name for name, field in Primer._meta.fields.items()
+            if field.default is not None)
+        _write_in_chunks(
             primer_dicts,
             fn=lambda c: Primer.insert_many(c).execute(),
-            n=199,
+            n=max(1, SQLITE_MAX_VARIABLES // len(columns)),
             label="Updating database: ")
 
-
     def __init__(self, primers=None):
         """Create a new list of primers.
 
         :param primers: a list of Primer objects or a list of primer sequences.
         If None, selects all primers.
         """
-        if primers is None:
-            self._primers = Primer.select()
-            self.n = int(self._primers.count())
-        elif isinstance(primers, file):
-            self._primers = read_primer_list(primers)
-            self.n = len(self._primers)
-        else:
-            self._primers = Primer.select().where(Primer.seq << primers)
-            self.n = int(self._primers.count())
+        # The predicates that select the primers in the list
+        self._where = []
+        # Filters that haven't been applied yet, as (predicate, description)
+        self._pending = []
+        # The number of primers in the list; None until they are counted,
+        # which is done along with applying the first filters
+        self.n = None
+        if isinstance(primers, file):
+            primers = read_primer_list(primers)
+            self._where = [Primer.seq << [p.seq for p in primers]]
+            self.n = len(primers)
+        elif primers is not None:
+            self._where = [Primer.seq << primers]
 
     @property
     def primers(self):
-        return self._primers
+        """The query selecting the primers in the list."""
+        query = Primer.select()
+        where = self._condition()
+        return query if where is None else query.where(where)
 
-    @primers.setter
-    def primers(self, value):
-        self._primers = value
+    def _condition(self, *predicates):
+        """Return the predicates selecting the list (and any others) and-ed
+        together, or None if they select every primer."""
+        self._apply()
+        predicates = self._where + list(predicates)
+        return reduce(operator.and_, predicates) if predicates else None
+
+    def _select(self, *predicates):
+        return Primer.select().where(self._condition(*predicates))
 
     def __len__(self):
+        self._apply()
         return self.n
 
     def __getitem__(self, key):
         return self.primers[key]
 
     def __iter__(self):
-        query = (
-            Primer.select()
-            .where(Primer.seq << self.primers)
-            .order_by(Primer._id)
-        )
-        return query.iterator()
+        return self.primers.order_by(Primer._id).iterator()
+
+    def _apply(self):
+        """Apply any pending filters.
+
+        The number of primers passing each filter in turn is counted in a
+        single query, which sums each running conjunction of the predicates.
+        """
+        if not self._pending and self.n is not None:
+            return
+        pending, self._pending = self._pending, []
+        columns = [fn.Count(Primer.seq)]
+        passing = []
+        for predicate, _ in pending:
+            passing.append(predicate)
+            columns.append(fn.Sum(reduce(operator.and_, passing)))
+        query = Primer.select(*columns)
+        if self._where:
+            query = query.where(reduce(operator.and_, self._where))
+        counts = [int(count or 0) for count in query.tuples().get()]
+        self.n = counts[0]
+        for (predicate, description), passed in zip(pending, counts[1:]):
+            message('{}/{} primers {}'.format(passed, self.n, description))
+            self._where.append(predicate)
+            self.n = passed
+            if passed == 0:
+                error('No primers left.', exception=False)
 
     @_filter
     def filter_min_fg_rate(self, min_bind):
         """Remove primers that bind less than `min_bind` to the foreground."""
-        results = Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer.fg_freq >= min_bind))
-        message(
-            '{}/{} primers bind the foreground genome >= {} times'
-            .format(results.count(), self.n, min_bind))
-        return results
+        return (
+            Primer.fg_freq >= min_bind,
+            'bind the foreground genome >= {} times'.format(min_bind))
 
     @_filter
     def filter_max_bg_rate(self, rate):
         """Remove primers that bind more than `rate` to the background genome."""
-        results = Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer.bg_freq <= rate))
-        message(
-            '{}/{} primers bind the background genome <= {} times'
-            .format(results.count(), self.n, rate))
-
-        return results
+        return (
+            Primer.bg_freq <= rate,
+            'bind the background genome <= {} times'.format(rate))
 
     @_filter
     def filter_tm_range(self, min_tm, max_tm):
@@ -155,16 +196,10 @@ class Primers(object):
         Finds any missing melt temps for primers.
         """
         self.update_melt_temps()
-        results = Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer.tm <= max_tm) &
-            (Primer.tm >= min_tm))
-        message(
-            '{}/{} primers have a melting temp between {} and {} C'
-            .format(results.count(), self.n, min_tm, max_tm))
-        return results
+        return (
+            (Primer.tm <= max_tm) & (Primer.tm >= min_tm),
+            'have a melting temp between {} and {} C'.format(min_tm, max_tm))
 
-    @_filter
     def limit_to(self, n):
         """
         Sort by background binding rate, selects the top `n` least frequently
@@ -173,63 +208,62 @@ class Primers(object):
         if n < 1:
             raise ValueError('n must be greater than 1')
 
+        # The subquery is run again each time the list is used, so ties are
+        # broken by sequence to make sure it selects the same primers
         first_pass = (
-            Primer.select().where(Primer.seq << self.primers)
-            .order_by(Primer.bg_freq)
+            Primer.select(Primer.seq).where(self._condition())
+            .order_by(Primer.bg_freq, Primer.seq)
             .limit(n))
 
-        results = (Primer
-                   .select().where(Primer.seq << first_pass)
-                   .order_by(Primer.ratio.desc()))
-
-        return results
+        self._where = [Primer.seq << first_pass]
+        self.n = min(n, self.n)
+        return self
 
     @_filter
-    def filter_max_gini(self, gini_max, fg_genome_fp):
+    def filter_max_gini(self, gini_max, fg_genome_fp, workers=1):
         """Remove primers with Gini coefficients less than `gini_max`.
 
         Finds binding locations and Gini coefficients for primers that do not
         have them already.
 
         :param gini_max: max Gini coefficient (0-1)
+        :param workers: the number of processes used to find binding locations
         """
         if 0 > gini_max > 1:
             raise ValueError('Gini coefficient must be between 0-1')
 
         (self
-         .update_locations(fg_genome_fp)
+         .update_locations(fg_genome_fp, workers)
          .update_gini(fg_genome_fp))
 
-        results = Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer.gini <= gini_max))
+        return (
+            Primer.gini <= gini_max,
+            'have a Gini coefficient <= {}'.format(gini_max))
 
-        message(
-            '{}/{} primers have a Gini coefficient <= {}'
-            .format(results.count(), self.n, gini_max))
+    @_update('_locations')
+    def update_locations(self, fg_genome_fp, workers=1):
+        """Find binding locations for any primers that don't have them.
 
-        return results
+        All the primers are located in a single pass over the genome.
 
-    @_update
-    def update_locations(self, fg_genome_fp):
-        """Find binding locations for any primers that don't have them."""
-        targets = list(Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer._locations >> None)))
+        :param workers: the number of processes used to scan the genome
+        """
+        targets = list(self._select(Primer._locations >> None))
         if len(targets) > 0:
             message(
                 'Finding binding locations for {} primers...'
                 .format(len(targets)))
-        for primer in targets:
-            primer._update_locations(fg_genome_fp)
+            all_locations = locate.multi_binding_sites(
+                [primer.seq for primer in targets], fg_genome_fp, workers)
+            chr_ends = locate.chromosome_ends(fg_genome_fp)
+            for primer, locations in zip(targets, all_locations):
+                primer._locations = locate.pack_locations(locations, chr_ends)
         return targets
 
-    @_update
+    @_update('gini')
     def update_gini(self, fg_genome_fp):
         """Calculate Gini coef for any primers that don't have it."""
-        targets = list(Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer.gini >> None)))
+        targets = list(self._select(Primer.gini >> None))
         if len(targets) > 0:
             message(
                 'Finding Gini coefficients for {} primers...'
@@ -238,37 +272,35 @@ class Primers(object):
             primer._update_gini(fg_genome_fp)
         return targets
 
-    @_update
+    @_update('tm')
     def update_melt_temps(self):
         """Calculate melting temp for any primers that don't have it."""
-        targets = list(Primer.select().where(
-            (Primer.seq << self.primers) &
-            (Primer.tm >> None)))
+        targets = list(self._select(Primer.tm >> None))
         if len(targets) > 0:
             message(
                 'Finding melting temps for {} primers...'
                 .format(len(targets)))
-        for primer in targets:
-            primer.update_tm()
+        # Temps are stored with the primers, so each is only found once
+        tms = thermo.temps([primer.seq for primer in targets])
+        for primer, tm in zip(targets, tms):
+            primer.tm = tm
         return targets
 
-    @_update
+    @_update('_id')
     def assign_ids(self):
         """Assign sequential ids to active primers.
 
         Resets any ids previously set.
         """
         Primer.update(_id=-1).execute()
-        primers = list(
-            Primer.select()
-            .where(Primer.seq << self.primers)
-            .order_by(Primer.ratio.desc()).execute())
+        primers = list(self.primers.order_by(Primer.ratio.desc()).execute())
         for i, primer in enumerate(primers):
             primer._id = i + 1
         return primers
 
     def summarize(self):
         """Output the number of primers currently in list."""
+        self._apply()
         message('{} primers satisfy all filters so far.'.format(self.n))
         return self
 
@@ -278,9 +310,9 @@ class Primers(object):
         :param min_active: The maximum number expected to activate. Warns if
         fewer than this number.
         """
-        n = (Primer.update(active=True)
-             .where(Primer.seq << self.primers)
-             .execute())
+        query = Primer.update(active=True)
+        where = self._condition()
+        n = (query if where is None else query.where(where)).execute()
         message('Marked {} primers as active.'.format(n))
         if n < min_active:
             message(
@@ -289,34 +321,52 @@ class Primers(object):
                 'parameters.'.format(min_active, n))
         return self
 
-    def _update_n(self):
-        n = self.primers.count()
-        if n == 0:
-            error('No primers left.', exception=False)
-        else:
-            self.n = n
-
     @staticmethod
-    def _update_in_chunks(targets, chunksize=100, show_progress=True,
-                          label='Updating primer db...'):
-        """Update the records for the list of primers in chunks.
+    def _update_in_chunks(targets, fields, chunksize=UPDATE_CHUNK,
+                          show_progress=True, label='Updating primer db...'):
+        """Write some of the fields of a list of primers to the database.
 
-        Technically, this performs an upsert, where primer records are updated
-        or inserted as needed. This is faster than updating the records for
-        each primer individually.
-        """
-        def upsert_chunk(chunk):
-            Primer.delete().where(Primer.seq << chunk).execute()
-            Primer.insert_many(p.to_dict() for p in chunk).execute()
+        Only the given columns are written, by one UPDATE statement run for
+        all the primers (with executemany) in a single transaction.
 
-        utils.chunk_iterator(
-            itr=targets,
-            fn=upsert_chunk,
+        :param targets: a list of Primer objects
+        :param fields: the names of the fields to write
+        """
+        fields = [Primer._meta.fields[name] for name in fields]
+        sql = 'UPDATE "{}" SET {} WHERE "{}" = ?'.format(
+            Primer._meta.db_table,
+            ', '.join('"{}" = ?'.format(f.db_column) for f in fields),
+            Primer.seq.db_column)
+
+        def update_chunk(chunk):
+            Primer._meta.database.get_cursor().executemany(sql, [
+                [f.db_value(getattr(p, f.name)) for f in fields] + [p.seq]
+                for p in chunk])
+
+        _write_in_chunks(
+            targets,
+            fn=update_chunk,
             n=chunksize,
             show_progress=show_progress,
             label=label)
 
 
+def _write_in_chunks(rows, fn, n, show_progress=True, label=None):
+    """Apply a database write to chunks of rows, in a single transaction.
+
+    Takes the same arguments as utils.chunk_iterator, and reports how many
+    rows were written per second if show_progress is True.
+    """
+    start = time.time()
+    with Primer._meta.database.atomic():
+        utils.chunk_iterator(
+            rows, fn=fn, n=n, show_progress=show_progress, label=label)
+    elapsed = time.time() - start
+    if show_progress and len(rows) > 0:
+        message('Wrote {:,} primers in {:.1f}s ({:,.0f}/s)'.format(
+            len(rows), elapsed, len(rows) / max(elapsed, 1e-6)))
+
+
 def read_primer_list(lines):
     """Read in a list of primers and return their records from the db.
 
@@ -5,8 +5,11 @@ Functions for retrieving and scoring primer sets.
 
 """
 
+import ast
 import importlib
 
+import numpy as np
+
 import locate
 import stats
 
@@ -24,33 +27,166 @@ def read_set_finder_line(line):
     return (primer_set, float(weight))
 
 
-def default_score_set(expression, primer_set, primer_locs, max_dist, bg_dist_mean):
+# The variables a score expression can use, as calculated for each set
+SCORE_VARIABLES = (
+    'set_size', 'fg_dist_mean', 'fg_dist_std', 'fg_dist_gini',
+    'bg_dist_mean', 'fg_max_dist')
+
+
+class ScoreExpression(object):
+
+    """A score expression, parsed and compiled once for scoring many sets.
+
+    Only arithmetic, comparisons and boolean logic on numbers and the
+    variables in SCORE_VARIABLES are allowed (no function calls, attributes,
+    etc). Expressions made only of arithmetic and comparisons can also be
+    evaluated on arrays of metrics, scoring many sets at once.
+    """
+
+    _ALLOWED = (
+        ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.BoolOp,
+        ast.IfExp, ast.Num, ast.Name, ast.Load, ast.operator, ast.unaryop,
+        ast.cmpop, ast.boolop)
+    # Nodes that don't work element-wise on arrays
+    _SCALAR_ONLY = (ast.BoolOp, ast.IfExp, ast.Not)
+
+    def __init__(self, expression):
+        """Parse and check a score expression.
+
+        :param expression: the expression, in Python syntax
+        :raises NameError: if the expression uses unknown variables
+        :raises ValueError: if the expression isn't a valid score expression
+        """
+        self.expression = expression
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError(
+                "Invalid score expression '{}': {}".format(expression, e))
+        variables = set()
+        self.vectorized = True
+        for node in ast.walk(tree):
+            if not isinstance(node, self._ALLOWED):
+                raise ValueError(
+                    "Invalid score expression '{}': {} not allowed".format(
+                        expression, type(node).__name__))
+            if (isinstance(node, self._SCALAR_ONLY) or
+                    isinstance(node, ast.Compare) and len(node.ops) > 1):
+                self.vectorized = False
+            if isinstance(node, ast.Name):
+                if node.id not in SCORE_VARIABLES:
+                    raise NameError(
+                        "name '%s' is not defined. Permitted variables are "
+                        "%s. Refer to README or docs for help." %
+                        (node.id, ", ".join(SCORE_VARIABLES)))
+                variables.add(node.id)
+        # The variables used by the expression (in SCORE_VARIABLES order)
+        self.variables = tuple(v for v in SCORE_VARIABLES if v in variables)
+        self._code = compile(tree, '<score_expression>', 'eval')
+
+    def __str__(self):
+        return self.expression
+
+    def __call__(self, **metrics):
+        """Score one set.
+
+        :param metrics: the value of (at least) each variable the expression
+        uses
+        """
+        return eval(
+            self._code, {'__builtins__': {}},
+            {name: metrics[name] for name in self.variables})
+
+    def evaluate_batch(self, metrics):
+        """Score many sets at once.
+
+        Unlike scoring each set, dividing by zero gives inf or nan instead
+        of raising an error.
+
+        :param metrics: a dict of the values of (at least) each variable the
+        expression uses, as equal-length arrays
+        :returns: an array of the scores of each set
+        """
+        columns = {name: np.asarray(metrics[name]) for name in self.variables}
+        n = len(next(iter(metrics.values()))) if metrics else 0
+        if not self.vectorized:
+            return np.array([
+                self(**{name: col[i] for name, col in columns.items()})
+                for i in xrange(n)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = eval(self._code, {'__builtins__': {}}, columns)
+        return np.resize(scores, n)
+
+
+def default_score_set(expression, primer_set, primer_locs, max_dist,
+                      bg_dist_mean, metrics=None):
     """Evaluate an expression using the provided values and a set of metrics.
 
+    :param expression: the score expression (a string or ScoreExpression)
+    :param metrics: the stats.SiteMetrics of `primer_locs`, if they've already
+    been calculated
     :returns: the score and the metrics used to calculate it
     """
+    if not isinstance(expression, ScoreExpression):
+        expression = ScoreExpression(expression)
     # Calculate various metrics
-    binding_distances = stats.seq_diff(primer_locs)
+    if metrics is None:
+        metrics = stats.site_metrics(primer_locs)
     namespace = {
         'set_size': len(primer_set),
-        'fg_dist_mean': stats.mean(binding_distances),
-        'fg_dist_std': stats.stdev(binding_distances),
-        'fg_dist_gini': stats.gini(binding_distances),
+        'fg_dist_mean': metrics.mean,
+        'fg_dist_std': metrics.std,
+        'fg_dist_gini': metrics.gini,
         'bg_dist_mean': bg_dist_mean,
-        'fg_max_dist': max_dist,
-        '__builtins__': None}
-    permitted_var_str = ", ".join(
-        [key for key in namespace.keys() if key is not "__builtins__"])
-    score = None
-    try:
-        score = eval(expression, namespace, {'__builtins__': {}})
-    except NameError as e:
-        raise NameError(
-            e.message +
-            '. Permitted variables are %s. Refer to README or docs for help.'
-            % permitted_var_str)
-    del namespace['__builtins__']
-    return score, namespace
+        'fg_max_dist': max_dist}
+    return expression(**namespace), namespace
+
+
+def score_sets(expression, primer_sets, locations, chr_ends, bg_length,
+               bg_dist_means=None):
+    """Score many sets at once.
+
+    The metrics of every set are calculated into arrays and the expression is
+    evaluated on all of them together (see ScoreExpression.evaluate_batch).
+    Sets' binding sites are only merged if the expression uses the metrics
+    calculated from them.
+
+    :param expression: a ScoreExpression
+    :param primer_sets: a list of sets, each a list of primer keys in
+    `locations`
+    :param locations: a locate.LocationCache holding every primer in the sets
+    :param chr_ends: the start and ends of each record in the foreground genome
+    :param bg_length: the total length of the background genome
+    :param bg_dist_means: the average distance between binding sites on the
+    background genome for each set (e.g. from set_finder), if known;
+    otherwise they're calculated as in calculate_bg_dist_mean
+    :returns: an array of the sets' scores, and a dict of the metrics used to
+    calculate them (as arrays)
+    """
+    metrics = {
+        'set_size': np.array([len(s) for s in primer_sets], dtype=np.int64)}
+    if bg_dist_means is not None:
+        metrics['bg_dist_mean'] = np.array(bg_dist_means, dtype=np.float64)
+    elif 'bg_dist_mean' in expression.variables:
+        bg_freqs = np.array([
+            sum(p.bg_freq for p in locations.primers(s))
+            for s in primer_sets], dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            metrics['bg_dist_mean'] = float(bg_length) / bg_freqs
+    site_variables = [
+        v for v in ('fg_dist_mean', 'fg_dist_std', 'fg_dist_gini',
+                    'fg_max_dist')
+        if v in expression.variables]
+    if site_variables:
+        rows = [
+            stats.site_metrics(locate.merge_sites(locations.sites(s), chr_ends))
+            for s in primer_sets]
+        metrics.update({
+            'fg_dist_mean': np.array([m.mean for m in rows]),
+            'fg_dist_std': np.array([m.std for m in rows]),
+            'fg_dist_gini': np.array([m.gini for m in rows]),
+            'fg_max_dist': np.array([m.max for m in rows], dtype=np.int64)})
+    return expression.evaluate_batch(metrics), metrics
 
 
 def calculate_bg_dist_mean(primers, bg_length):
@@ -71,7 +207,7 @@ def calculate_bg_dist_mean(primers, bg_length):
 
 
 def score_set(primers, max_fg_bind_dist, bg_dist_mean,
-              chr_ends, score_fun, interactive=False):
+              chr_ends, score_fun, interactive=False, sites=None):
     """Score a set using the provided `score_fun`.
 
     :param bg_dist_mean: the average distance between binding sites on the
@@ -79,20 +215,66 @@ def score_set(primers, max_fg_bind_dist, bg_dist_mean,
     :param chr_ends: the start and ends of each record in the foreground genome.
     :param score_fun: the scoring function
     :param interactive: if True, don't abort early due to set not passing filter
+    :param sites: the linearized binding sites of each primer (e.g. from a
+    `locate.LocationCache`); if None, they're read from the primers
+    :returns: the score (or False if the set didn't pass), the metrics used
+    to calculate it, and the largest distance between binding sites. For sets
+    rejected early, the distance is only a lower bound.
     """
-    binding_locations = locate.linearize_binding_sites(
-        primers, chr_ends)
-    max_dist = max(stats.seq_diff(binding_locations))
+    if sites is None:
+        sites = [primer.linear_locations for primer in primers]
+
+    # Most sets fail the max distance filter, so we check that first without
+    # merging and sorting all the sites
+    if not interactive:
+        min_max_dist = max_dist_lower_bound(sites, chr_ends, max_fg_bind_dist)
+        if min_max_dist > max_fg_bind_dist:
+            return False, {}, min_max_dist
+
+    binding_locations = locate.merge_sites(sites, chr_ends)
+    max_dist = int(np.diff(binding_locations).max())
 
     # If it's not a user-supplied set and it's not passing the filter,
-    # abort immediately
+    # abort immediately (before calculating the rest of its metrics)
     if not interactive and max_dist > max_fg_bind_dist:
         return False, {}, max_dist
 
+    metrics = stats.site_metrics(binding_locations)
+
     set_score, variables = score_fun(
         primer_set=primers,
         primer_locs=binding_locations,
         max_dist=max_dist,
-        bg_dist_mean=bg_dist_mean)
+        bg_dist_mean=bg_dist_mean,
+        metrics=metrics)
 
     return set_score, variables, max_dist
+
+
+def max_dist_lower_bound(sites, chr_ends, max_dist):
+    """Find a lower bound on the largest distance between binding sites.
+
+    The genome is split into bins `max_dist` wide and the sites in each are
+    counted, which takes time linear in the number of sites (unlike sorting
+    them). The sites on either side of an empty bin must be more than
+    `max_dist` apart, so a set with an empty bin can be rejected right away.
+
+    :param sites: the linearized binding sites of each primer
+    :param chr_ends: the start and ends of each record in the foreground genome
+    :param max_dist: the largest allowed distance between sites
+    :returns: a lower bound that is > `max_dist` if there's an empty bin, and
+    0 otherwise (when only merging the sites can tell).
+    """
+    if max_dist < 1 or len(sites) == 0:
+        return 0
+    ends = np.array(chr_ends.values(), dtype=np.int64).ravel()
+    genome_length = int(ends.max()) + 1
+    nbins = -(-genome_length // max_dist)
+    nsites = sum(len(s) for s in sites) + len(ends)
+    if nbins > nsites:
+        # There must be an empty bin; the mean distance is also a lower bound
+        return max(max_dist + 1, -(-(genome_length - 1) // (nsites - 1)))
+    bins = np.concatenate(list(sites) + [ends]) // max_dist
+    occupied = np.flatnonzero(np.bincount(bins, minlength=nbins))
+    empty_run = np.diff(occupied).max() - 1 if len(occupied) > 1 else 0
+    return empty_run * max_dist + 1 if empty_run > 0 else 0
@@ -1,9 +1,18 @@
 import os
 import time
+import select
 import signal
 import subprocess
 
+import numpy as np
+
 import utils
+from swga import message
+
+# Bytes read from set_finder's output at a time
+READ_SIZE = 1 << 16
+# The largest primer id that fits in set_finder's binary output
+MAX_BINARY_ID = 65535
 
 
 def find(**kwargs):
@@ -14,8 +23,14 @@ def find(**kwargs):
     :param min_size: smallest allowable set size
     :param max_size: largest allowable set size
     :param graph_fp: compatibility graph file
-    :param workers: if <= 1, searches graph in order of primer binding. If >1,
-    searches graph from x randomly-chosen points in parallel.
+    :param workers: the number of set_finder processes. If > 1, the search is
+    split into that many disjoint parts, searched in parallel.
+    :param binary: if True, set_finder writes binary records and the sets are
+    yielded as ([primer_id1, primer_id2, ...], weight) tuples; otherwise the
+    lines of text it outputs are yielded (see score.read_set_finder_line).
+    :param timeout: if given, None is yielded whenever set_finder hasn't
+    output anything for this many seconds, so that callers can do other work
+    (e.g. check a time limit) while it searches
     """
     workers = kwargs.get('workers', 1)
     if workers <= 1:
@@ -24,48 +39,177 @@ def find(**kwargs):
         return _mp_find_sets(**kwargs)
 
 
-def _find_sets(min_bg_bind_dist, bg_length, min_size, max_size, graph_fp,
-               vertex_ordering="weighted-coloring"):
-    assert vertex_ordering in ["weighted-coloring", "random"]
-    find_set_cmd = [
-        utils.set_finder(), '-q', '-q',
-        '--bg_freq', min_bg_bind_dist,
-        '--bg_len', bg_length,
-        '--min', min_size,
-        '--max', max_size,
-        '--unweighted',
-        '--all',
-        '--reorder', vertex_ordering,
-        graph_fp
-    ]
-    find_set_cmd = " ".join([str(_) for _ in find_set_cmd])
-
-    # We call the set_finder command as a line-buffered subprocess that
-    # passes its output back to this process.
-    # The function then yields each line as a generator; when close() is
+class SetFinder(object):
+
+    """A running set_finder process, and a decoder for its output."""
+
+    def __init__(self, min_bg_bind_dist, bg_length, min_size, max_size,
+                 graph_fp, vertex_ordering="weighted-coloring", binary=False,
+                 partition=None):
+        assert vertex_ordering in ["weighted-coloring", "random"]
+        find_set_cmd = [
+            utils.set_finder(), '-q', '-q',
+            '--bg_freq', min_bg_bind_dist,
+            '--bg_len', bg_length,
+            '--min', min_size,
+            '--max', max_size,
+            '--unweighted',
+            '--all',
+            '--reorder', vertex_ordering,
+        ]
+        if binary:
+            find_set_cmd.append('--binary')
+        if partition:
+            find_set_cmd += ['--partition', '{}/{}'.format(*partition)]
+        find_set_cmd = [str(_) for _ in find_set_cmd + [graph_fp]]
+
+        self.binary = binary
+        self.dtype = binary_record_dtype(int(max_size)) if binary else None
+        self.sets_found = 0
+        self.started = time.time()
+        self.finished = None
+        self._leftover = b''
+        # set_finder runs in its own process group so that stop() can kill
+        # it along with anything it spawns
+        self.process = subprocess.Popen(
+            find_set_cmd,
+            stdout=subprocess.PIPE,
+            preexec_fn=os.setsid)
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def ready(self, timeout=None):
+        """Wait up to `timeout` seconds for output (or set_finder to exit).
+
+        :returns: True if `read` won't block
+        """
+        return bool(select.select([self], [], [], timeout)[0])
+
+    def read(self):
+        """Read the output available from set_finder and decode it.
+
+        Blocks until there is some output, or set_finder exits.
+
+        :returns: a list of sets (lines of text, or tuples in binary mode);
+        None once set_finder has exited and all its output has been read
+        """
+        chunk = os.read(self.fileno(), READ_SIZE)
+        if not chunk:
+            self.finished = time.time()
+            # Text output might not end with a newline
+            if self._leftover and not self.binary:
+                sets, self._leftover = [self._leftover], b''
+                self.sets_found += 1
+                return sets
+            return None
+        data = self._leftover + chunk
+        if self.binary:
+            n = len(data) // self.dtype.itemsize
+            self._leftover = data[n * self.dtype.itemsize:]
+            sets = _decode_binary_sets(data, self.dtype, n)
+        else:
+            end = data.rfind(b'\n') + 1
+            self._leftover = data[end:]
+            sets = data[:end].splitlines(True)
+        self.sets_found += len(sets)
+        return sets
+
+    def rate(self):
+        """Return the number of sets found per second."""
+        elapsed = (self.finished or time.time()) - self.started
+        return self.sets_found / elapsed if elapsed > 0 else 0.0
+
+    def stop(self):
+        """Kill set_finder if it's still running."""
+        if self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        self.process.stdout.close()
+        self.process.wait()
+
+
+def binary_record_dtype(max_size):
+    """The layout of the records written by `set_finder --binary`."""
+    return np.dtype([
+        ('size', '=u2'),
+        ('ids', '=u2', (max_size,)),
+        ('weight', '=f8')])
+
+
+def _decode_binary_sets(data, dtype, n):
+    """Decode the first n binary set_finder records in a string.
+
+    :returns: a list of ([primer_id1, primer_id2, ...], weight) tuples
+    """
+    if n == 0:
+        return []
+    records = np.frombuffer(data, dtype=dtype, count=n)
+    return [
+        (ids[:size], weight) for size, ids, weight in zip(
+            records['size'].tolist(),
+            records['ids'].tolist(),
+            records['weight'].tolist())]
+
+
+def _find_sets(timeout=None, **kwargs):
+    # We call the set_finder command as a subprocess that passes its output
+    # back to this process.
+    # The function then yields each set as a generator; when close() is
     # called, it terminates the set_finder subprocess.
-    process = subprocess.Popen(
-        find_set_cmd,
-        shell=True,
-        stdout=subprocess.PIPE,
-        preexec_fn=os.setsid,
-        bufsize=1)
+    setfinder = SetFinder(**kwargs)
     try:
-        for line in iter(process.stdout.readline, b''):
-            (yield line)
+        while True:
+            if timeout is not None and not setfinder.ready(timeout):
+                yield None
+                continue
+            sets = setfinder.read()
+            if sets is None:
+                break
+            for primer_set in sets:
+                (yield primer_set)
     finally:
-        time.sleep(0.1)
-        if process.poll() is None:
-            os.killpg(process.pid, signal.SIGKILL)
+        setfinder.stop()
+
 
+def _mp_find_sets(workers, timeout=None, **kwargs):
+    """Run several set_finders at once, yielding sets from whichever has some.
 
-def _mp_find_sets(workers, **kwargs):
-    setfinder_procs = [_find_sets(vertex_ordering="random", **kwargs)
-                       for _ in range(workers)]
+    Each set_finder searches a disjoint part of the graph (every clique is
+    found by exactly one of them), so they never repeat each other's sets.
+    The set_finders' outputs are polled, so a slow worker never holds up the
+    others, and the search continues until every worker has finished.
+    """
+    setfinders = []
+    running = {}
+    poller = select.poll()
     try:
-        while True:
-            for i, setfinder in enumerate(setfinder_procs):
-                (yield setfinder.next())
+        for i in range(workers):
+            setfinder = SetFinder(partition=(i, workers), **kwargs)
+            setfinders.append(setfinder)
+            running[setfinder.fileno()] = setfinder
+            poller.register(setfinder, select.POLLIN)
+        while running:
+            events = poller.poll(None if timeout is None else timeout * 1000)
+            if not events:
+                yield None
+            for fd, _ in events:
+                sets = running[fd].read()
+                if sets is None:
+                    poller.unregister(fd)
+                    del running[fd]
+                    continue
+                for primer_set in sets:
+                    (yield primer_set)
     finally:
-        for i, setfinder in enumerate(setfinder_procs):
-            setfinder.close()
\ No newline at end of file
+        for setfinder in setfinders:
+            setfinder.stop()
+        _report_throughput(setfinders)
+
+
+def _report_throughput(setfinders):
+    message("")
+    for i, setfinder in enumerate(setfinders):
+        message(
+            "set_finder worker {}: {:,} sets ({:,.0f}/s){}".format(
+                i + 1, setfinder.sets_found, setfinder.rate(),
+                ", finished" if setfinder.finished else ""))
@@ -2,10 +2,20 @@
 
 Functions used to score primer sets.
 
+The list-based functions (mean, stdev, seq_diff, gini) work on the distances
+between binding sites one value at a time; site_metrics computes all of them
+from a sorted array of sites at once with NumPy, and is what sets are scored
+with.
 """
 
+from collections import namedtuple
 from math import sqrt
 
+import numpy as np
+
+# The scoring metrics of a set of binding sites (see site_metrics)
+SiteMetrics = namedtuple('SiteMetrics', 'diffs mean std gini max')
+
 
 def mean(values):
     """Calculate the arithmetic mean."""
@@ -54,6 +64,36 @@ def gini(distances):
     return (fair_area - area) / fair_area
 
 
+def site_metrics(sites):
+    """Calculate the distances between binding sites and their metrics.
+
+    Gives the same results as seq_diff followed by mean, stdev, gini and max
+    on the distances, but makes a single copy of the sites (the distances).
+
+    :param sites: a sorted array of binding sites (e.g. from
+    locate.merge_sites)
+    :returns: a SiteMetrics tuple of the distances (sorted), their mean,
+    standard deviation and Gini coefficient, and the largest distance. The
+    statistics are NaN when there are too few distances to calculate them.
+    """
+    diffs = np.diff(np.asarray(sites, dtype=np.int64))
+    diffs.sort()
+    n = len(diffs)
+    if n == 0:
+        return SiteMetrics(diffs, float('nan'), float('nan'), float('nan'), 0)
+    total = int(diffs.sum())
+    mu = float(total) / n
+    std = (sqrt(float(np.square(diffs - mu).sum()) / (n - 1))
+           if n > 1 else float('nan'))
+    # See gini(): the area under the Lorenz curve is the sum of the running
+    # totals, less half of each value. The fair area is rounded down to an
+    # integer there, since it's computed from integers.
+    area = float(np.cumsum(diffs).sum()) - total / 2.
+    fair_area = total * n // 2
+    gini_ = (fair_area - area) / fair_area if fair_area else float('nan')
+    return SiteMetrics(diffs, mu, std, gini_, int(diffs[-1]))
+
+
 def lorenz(distances):
     """Calculate the Lorenz curve for a set of values.
 
@@ -67,15 +107,6 @@ def lorenz(distances):
 
     :param distances: a vector of primer binding distances (from each other)
     """
-    distances.sort()
-    height = 0
-    lz = []
-    for dist in distances:
-        height += dist
-        lz.append(height)
-
+    lz = np.cumsum(np.sort(distances))
     # Normalize output
-    _max = float(max(lz))
-    lz = [l / _max for l in lz]
-
-    return lz
+    return (lz / float(lz[-1])).tolist()
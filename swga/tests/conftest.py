@@ -40,11 +40,11 @@ def testdata_fp():
 def _fastafile(request, testdata_fp, fname):
     '''Returns a given FASTA file from tests/data, cleaning up afterward'''
     fa = os.path.join(testdata_fp, fname)
-    fai = fa + ".fai"
 
     def fin():
-        if os.path.exists(fai):
-            os.remove(fai)
+        for index in (fa + ".fai", fa + ".swga2bit"):
+            if os.path.exists(index):
+                os.remove(index)
     request.addfinalizer(fin)
     return fa
 
@@ -87,5 +87,6 @@ def metadata():
         bg_file='',
         ex_file='',
         fg_length=0,
-        bg_length=0
+        bg_length=0,
+        fg_records=None
     )
\ No newline at end of file
@@ -0,0 +1,41 @@
+import pytest
+
+import swga.dimers
+from swga.dimers import DimerTable
+from swga.kmers import max_sequential_nt
+
+SEQS = ["ATGCTC", "CAGCAT", "GAGGTA", "TTCCAC", "ATGC"]
+
+
+@pytest.mark.usefixtures('ws')
+class TestDimerTable:
+
+    def test_lookup(self):
+        dimers = DimerTable(SEQS)
+        for seq1 in SEQS:
+            for seq2 in SEQS:
+                assert (dimers.max_dimer(seq1, seq2) ==
+                        max_sequential_nt(seq1, seq2))
+        assert dimers.max_dimer_within(SEQS[:2]) == max_sequential_nt(
+            SEQS[0], SEQS[1])
+        assert dimers.max_dimer_within(SEQS[:1]) == 0
+
+    def test_incremental(self, monkeypatch):
+        DimerTable(SEQS[:3])
+        aligned = []
+        pairwise = swga.dimers.pairwise_max_sequential_nt
+
+        def spy(seqs, others=None, **kwargs):
+            aligned.append(seqs)
+            return pairwise(seqs, others, **kwargs)
+        monkeypatch.setattr(swga.dimers, 'pairwise_max_sequential_nt', spy)
+
+        # Only sequences that haven't been seen are aligned
+        dimers = DimerTable(SEQS[::-1])
+        assert aligned == [sorted(SEQS[3:])]
+        DimerTable(SEQS[1:])
+        assert len(aligned) == 1
+        for seq1 in SEQS:
+            for seq2 in SEQS:
+                assert (dimers.max_dimer(seq1, seq2) ==
+                        max_sequential_nt(seq1, seq2))
@@ -0,0 +1,32 @@
+import pytest
+
+import swga.locate as locate
+from swga.export import BedGraph
+from swga.workspace import Primer, Set
+
+
+@pytest.mark.parametrize('window_size, step_size', [(4, 1), (5, 2), (30, 3)])
+def test_bedgraph_hits(ws, fastafile, window_size, step_size):
+    '''Hits per window must match counting the sites one by one.'''
+    chr_ends = locate.chromosome_ends(fastafile)
+    locations = [
+        {'record1': [0, 3, 3, 9, 14], 'record2': [1, 7]},
+        {'record1': [5, 9], 'record2': []}]
+    primers = [
+        Primer.create(
+            seq=seq, _locations=locate.pack_locations(locs, chr_ends))
+        for seq, locs in zip(["AAGG", "ACGT"], locations)]
+    Set.add(1, primers, score=1)
+    bedgraph = BedGraph(
+        Set.get(Set._id == 1), fastafile, "", window_size, step_size)
+
+    results = list(bedgraph._hits_per_record())
+    assert [record for record, _, _ in results] == sorted(chr_ends)
+    for record, midpoints, hits in results:
+        length = chr_ends[record][1] - chr_ends[record][0] + 1
+        window = min(window_size, length)
+        sites = sum((locs.get(record, []) for locs in locations), [])
+        starts = range(0, length - window, min(step_size, window))
+        assert midpoints.tolist() == [(2 * s + window) // 2 for s in starts]
+        assert hits.tolist() == [
+            sum(s <= site < s + window for site in sites) for s in starts]
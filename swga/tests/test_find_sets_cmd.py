@@ -30,24 +30,25 @@ e 2 3
 """
 
 
+GRAPH = ('p sp 6 7\n'
+         'n 1 1\n'
+         'n 2 2\n'
+         'n 3 1\n'
+         'n 4 4\n'
+         'n 5 5\n'
+         'n 6 6\n'
+         'e 1 2\n'
+         'e 1 3\n'
+         'e 2 3\n'
+         'e 2 4\n'
+         'e 4 5\n'
+         'e 4 6\n'
+         'e 5 6\n')
+
+
 def test_find_sets(tmpdir):
-    from swga.commands import FindSets
-    graph = ('p sp 6 7\n'
-             'n 1 1\n'
-             'n 2 2\n'
-             'n 3 1\n'
-             'n 4 4\n'
-             'n 5 5\n'
-             'n 6 6\n'
-             'e 1 2\n'
-             'e 1 3\n'
-             'e 2 3\n'
-             'e 2 4\n'
-             'e 4 5\n'
-             'e 4 6\n'
-             'e 5 6\n')
     fp = tmpdir.join("testgraph")
-    fp.write(graph)
+    fp.write(GRAPH)
     sets = swga.sets.find(
         min_bg_bind_dist=2,
         min_size=3,
@@ -61,3 +62,62 @@ def test_find_sets(tmpdir):
     assert bg_dist_mean == 2.5
 
 
+def test_find_sets_binary(tmpdir, monkeypatch):
+    # Small reads make sure records split across reads are decoded
+    monkeypatch.setattr(swga.sets, 'READ_SIZE', 7)
+    fp = tmpdir.join("testgraph")
+    fp.write(GRAPH)
+    kwargs = dict(
+        min_bg_bind_dist=0, min_size=2, max_size=4, bg_length=10,
+        graph_fp=str(fp))
+    text = [swga.score.read_set_finder_line(line)
+            for line in swga.sets.find(**kwargs)]
+    binary = list(swga.sets.find(binary=True, **kwargs))
+    assert len(binary) == len(text) > 1
+    for (ids, weight), (text_ids, text_weight) in zip(binary, text):
+        assert ids == text_ids
+        assert abs(weight - text_weight) < 1e-6
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_find_sets_workers(tmpdir, binary):
+    fp = tmpdir.join("testgraph")
+    fp.write(GRAPH)
+    kwargs = dict(
+        min_bg_bind_dist=0, min_size=2, max_size=4, bg_length=10,
+        graph_fp=str(fp), binary=binary)
+    single = list(swga.sets.find(**kwargs))
+    # Each worker searches a different part of the graph, and all of them run
+    # to the end
+    multi = list(swga.sets.find(workers=3, **kwargs))
+    assert sorted(multi) == sorted(single)
+
+
+def test_top_sets():
+    from swga.commands.find_sets import TopSets
+    top = TopSets(3, stop_after_sets=4)
+    scores = [5.0, False, 3.0, 4.0, 6.0, 1.0, 3.0, 2.0]
+    kept = [top.add([i], s, {'i': i}) for i, s in enumerate(scores)]
+    assert kept == [True, False, True, True, False, True, True, True]
+    # Lowest scores first; the tie at 3.0 goes to the set found first
+    assert top.sets() == [
+        ([5], 1.0, {'i': 5}), ([7], 2.0, {'i': 7}), ([2], 3.0, {'i': 2})]
+    assert top.changed and not top.stalled()
+    for i in range(4):
+        assert not top.stalled()
+        top.add([10 + i], 10.0, {})
+    assert top.stalled()
+
+
+def test_find_sets_timeout(tmpdir, monkeypatch):
+    '''None is yielded while set_finder is quiet for longer than timeout.'''
+    script = tmpdir.join("slow_set_finder")
+    script.write("#!/bin/sh\necho '1,2 5.0'\nsleep 1\necho '3,4 6.0'\n")
+    script.chmod(0o755)
+    monkeypatch.setattr(swga.sets.utils, 'set_finder', lambda: str(script))
+    output = list(swga.sets.find(
+        min_bg_bind_dist=2, min_size=2, max_size=2, bg_length=10,
+        graph_fp="unused", timeout=0.2))
+    lines = [line for line in output if line is not None]
+    assert lines == ['1,2 5.0\n', '3,4 6.0\n']
+    assert output.index(None) > 0
@@ -0,0 +1,51 @@
+import os
+import pytest
+import swga.genome
+from swga.genome import Genome
+
+
+@pytest.fixture
+def messy_fasta(tmpdir):
+    '''A FASTA file with Ns, soft-masked bases and an empty record.'''
+    fa = tmpdir.join("messy.fa")
+    fa.write(">rec1 some description\nACGTNNACgtac\nTTGCA\n"
+             ">rec2\n\n>rec3\nNNNNACG\n")
+    return str(fa)
+
+
+def test_pack_genome(messy_fasta, monkeypatch):
+    # Small chunks make sure invalid blocks are merged across chunks
+    monkeypatch.setattr(swga.genome, '_PACK_CHUNK', 4)
+    genome = Genome.open(messy_fasta)
+    assert os.path.isfile(messy_fasta + ".swga2bit")
+    assert genome.keys() == ["rec1", "rec2", "rec3"]
+    assert len(genome) == 24
+    assert genome.sequence("rec1") == "ACGTNNACNNNNTTGCA"
+    assert genome.sequence("rec2") == ""
+    assert genome.sequence("rec3") == "NNNNACG"
+    assert genome.sequence("rec1", 3, 9) == "TNNACN"
+    assert list(genome.codes("rec1", 0, 6)) == [0, 1, 2, 3, 4, 4]
+
+
+def test_repack_changed_genome(messy_fasta):
+    genome = Genome.open(messy_fasta)
+    assert genome.sequence("rec3") == "NNNNACG"
+    mtime = os.stat(messy_fasta).st_mtime
+    with open(messy_fasta, 'w') as fa:
+        fa.write(">rec3\nTTTT\n")
+    os.utime(messy_fasta, (mtime + 10, mtime + 10))
+    genome = Genome.open(messy_fasta)
+    assert genome.keys() == ["rec3"]
+    assert genome.sequence("rec3") == "TTTT"
+
+
+def test_pack_in_workspace(messy_fasta, tmpdir, monkeypatch):
+    '''Genomes in read-only directories are packed into the workspace.'''
+    ws_dir = tmpdir.mkdir("workspace")
+    monkeypatch.chdir(ws_dir)
+    monkeypatch.setattr(os, 'access', lambda path, mode: False)
+    genome = Genome.open(messy_fasta)
+    assert not os.path.isfile(messy_fasta + ".swga2bit")
+    assert os.path.dirname(genome.fp) == str(ws_dir)
+    assert genome.sequence("rec3") == "NNNNACG"
+    assert Genome.open(messy_fasta).fp == genome.fp
@@ -1,8 +1,9 @@
 #from __future__ import absolute_import
 import pytest
 
-from swga.workspace import Primer
+from swga.workspace import Primer, _dimers, _graph_cache
 from swga import graph
+from swga.kmers import max_sequential_nt, pairwise_max_sequential_nt
 
 
 @pytest.mark.usefixtures('ws')
@@ -50,4 +51,47 @@ class TestGraph:
         edges = graph.build_edges([ref_primer, subseq_primer], 2)
         assert edges == []
 
-        
+    def test_pairwise_heterodimers(self, primers):
+        '''Batched heterodimer check must agree with max_sequential_nt.'''
+        seqs = [p.seq for p in primers] + ["ACGT" * 8, "TTGCA"]
+        binding = pairwise_max_sequential_nt(seqs, blocksize=3)
+        for i, seq1 in enumerate(seqs):
+            for j, seq2 in enumerate(seqs):
+                assert binding[i, j] == max_sequential_nt(seq1, seq2)
+
+    def test_pairwise_heterodimers_rectangular(self, primers):
+        seqs = [p.seq for p in primers]
+        others = ["ACGT" * 8, "TTGCA", "GAGCAT"]
+        binding = pairwise_max_sequential_nt(seqs, others, blocksize=4)
+        assert binding.shape == (len(seqs), len(others))
+        for i, seq1 in enumerate(seqs):
+            for j, seq2 in enumerate(others):
+                assert binding[i, j] == max_sequential_nt(seq1, seq2)
+
+
+def test_build_graph_reuses_cache(ws, tmpdir, monkeypatch):
+    outfile = str(tmpdir.join("graph"))
+    for i, seq in enumerate(["ATGCTC", "TTCCAC", "GGAAGG"]):
+        Primer.create(seq=seq, bg_freq=i + 1, ratio=i, active=True)
+    graph.build_graph(2, outfile)
+    expected = open(outfile).read()
+
+    # Nothing changed: the graph isn't rebuilt at all
+    def fail(*args, **kwargs):
+        raise AssertionError("graph was rebuilt")
+    monkeypatch.setattr(graph, 'compatibility_matrix', fail)
+    graph.build_graph(2, outfile)
+    assert open(outfile).read() == expected
+    monkeypatch.undo()
+
+    # A new primer changes the graph
+    Primer.create(seq="CCATTA", bg_freq=5, ratio=10, active=True)
+    graph.build_graph(2, outfile)
+    updated = open(outfile).read()
+    assert updated.startswith("p sp 4 ")
+
+    # The same graph is built without any cached results
+    _graph_cache.delete().execute()
+    _dimers.delete().execute()
+    graph.build_graph(2, outfile)
+    assert open(outfile).read() == updated
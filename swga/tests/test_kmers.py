@@ -0,0 +1,143 @@
+import struct
+import pytest
+import swga.kmers
+
+
+def _pack(kmer):
+    '''Packs a k-mer the same way DSK does.'''
+    value = 0
+    for base in kmer:
+        value = (value << 2) | "ACTG".index(base)
+    return value
+
+
+@pytest.fixture
+def kmer_counts():
+    return [("ACGTA", 3), ("TTTTT", 1), ("GATCC", 12), ("AAAAA", 7)]
+
+
+@pytest.fixture
+def kmer_binary(tmpdir, kmer_counts):
+    fp = tmpdir.join("genome-5mers.solid_kmers_binary")
+    with open(str(fp), 'wb') as out:
+        out.write(struct.pack('ii', 64, 5))
+        for kmer, freq in kmer_counts:
+            out.write(struct.pack('<QI', _pack(kmer), freq))
+        # Trailing partial record should be ignored
+        out.write(b'\x00\x01')
+    return str(fp)
+
+
+def test_read_kmer_binary(kmer_binary, kmer_counts):
+    k, kmers, freqs = swga.kmers.read_kmer_binary(kmer_binary)
+    assert k == 5
+    assert list(kmers) == [_pack(kmer) for kmer, _ in kmer_counts]
+    assert list(freqs) == [freq for _, freq in kmer_counts]
+
+
+def test_decode_kmers(kmer_binary, kmer_counts):
+    k, kmers, _ = swga.kmers.read_kmer_binary(kmer_binary)
+    expected = [kmer for kmer, _ in kmer_counts]
+    assert swga.kmers.decode_kmers(kmers, k) == expected
+    assert swga.kmers.decode_kmers(kmers, k, chunksize=3) == expected
+
+
+def test_read_empty_kmer_binary(tmpdir):
+    fp = tmpdir.join("empty.solid_kmers_binary")
+    fp.write(struct.pack('ii', 64, 5), mode='wb')
+    k, kmers, freqs = swga.kmers.read_kmer_binary(str(fp))
+    assert k == 5
+    assert len(kmers) == len(freqs) == 0
+    assert swga.kmers.decode_kmers(kmers, k) == []
+
+
+def test_encode_kmers():
+    kmers, valid = swga.kmers.encode_kmers(["ACGTA", "ACNTA", "ACG"], 5)
+    assert list(valid) == [True, False, False]
+    assert kmers[0] == _pack("ACGTA")
+    assert swga.kmers.decode_kmers(kmers[valid], 5) == ["ACGTA"]
+
+
+def test_kmer_table(kmer_counts):
+    seqs = [kmer for kmer, _ in kmer_counts]
+    counts = [freq for _, freq in kmer_counts]
+    kmers, _ = swga.kmers.encode_kmers(seqs, 5)
+    table = swga.kmers.KmerTable(5, kmers, counts)
+    assert len(table) == 4
+    assert sorted(table.seqs()) == sorted(seqs)
+    assert "GATCC" in table
+    assert "CCCCC" not in table
+    assert "GATCN" not in table
+
+    queries, _ = swga.kmers.encode_kmers(["AAAAA", "CCCCC", "TTTTT"], 5)
+    assert list(table.contains(queries)) == [True, False, True]
+    assert list(table.lookup(queries)) == [7, 0, 1]
+
+
+def test_empty_kmer_table():
+    table = swga.kmers.KmerTable(5)
+    queries, _ = swga.kmers.encode_kmers(["AAAAA"], 5)
+    assert len(table) == 0
+    assert list(table.contains(queries)) == [False]
+    assert list(table.lookup(queries)) == [0]
+
+
+@pytest.fixture
+def kmer_table(kmer_counts):
+    kmers, _ = swga.kmers.encode_kmers([kmer for kmer, _ in kmer_counts], 5)
+    return swga.kmers.KmerTable(5, kmers, [freq for _, freq in kmer_counts])
+
+
+def test_kmer_cache(tmpdir, fastafile, kmer_table):
+    cache = swga.kmers.KmerCache(str(tmpdir.join("cache")), 1024 ** 2)
+    assert cache.get(fastafile, 5, 1) is None
+    cache.put(fastafile, 5, 1, kmer_table)
+    cached = cache.get(fastafile, 5, 1)
+    assert cached.k == 5
+    assert list(cached.kmers) == list(kmer_table.kmers)
+    assert list(cached.counts) == list(kmer_table.counts)
+    # Counts made with a different threshold or k are separate entries
+    assert cache.get(fastafile, 5, 2) is None
+    assert cache.get(fastafile, 6, 1) is None
+
+
+def test_kmer_cache_content_addressed(tmpdir, fastafile, kmer_table):
+    cache = swga.kmers.KmerCache(str(tmpdir.join("cache")), 1024 ** 2)
+    cache.put(fastafile, 5, 1, kmer_table)
+    # Same contents under a different name should hit the cache
+    copy = tmpdir.join("copy.fasta")
+    copy.write(open(fastafile).read())
+    assert cache.get(str(copy), 5, 1) is not None
+    # Different contents under the same name should not
+    copy.write(">other\nACGT\n")
+    assert cache.get(str(copy), 5, 1) is None
+
+
+def test_kmer_cache_eviction(tmpdir, fastafile, kmer_table):
+    import os
+    cache = swga.kmers.KmerCache(str(tmpdir.join("cache")), 1)
+    cache.put(fastafile, 5, 1, kmer_table)
+    first = cache.entry(fastafile, 5, 1)
+    os.utime(first, (0, 0))
+    cache.put(fastafile, 5, 2, kmer_table)
+    # Only the most recently added entry is kept
+    assert cache.get(fastafile, 5, 1) is None
+    assert cache.get(fastafile, 5, 2) is not None
+
+
+def test_kmer_cache_damaged_entry(tmpdir, fastafile, kmer_table):
+    import os
+    cache = swga.kmers.KmerCache(str(tmpdir.join("cache")), 1024 ** 2)
+    cache.put(fastafile, 5, 1, kmer_table)
+    fp = cache.entry(fastafile, 5, 1)
+    # Entries are readable by others (as allowed by the umask)
+    umask = os.umask(0o022)
+    try:
+        cache.put(fastafile, 5, 1, kmer_table)
+    finally:
+        os.umask(umask)
+    assert os.stat(fp).st_mode & 0o777 == 0o644
+    data = open(fp, 'rb').read()
+    with open(fp, 'wb') as entry:
+        entry.write(data[:len(data) // 2])
+    assert cache.get(fastafile, 5, 1) is None
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 import swga.primers
 import swga.locate
@@ -15,6 +17,25 @@ def test_locate_genome_positions(kmer, fastafile):
     assert locations['record2'] == []
 
 
+@pytest.mark.parametrize('workers', [1, 2])
+def test_locate_multiple_kmers(kmer, fastafile, monkeypatch, workers):
+    from pyfaidx import Fasta
+    # Small chunks make sure hits spanning chunk boundaries are found
+    monkeypatch.setattr(swga.locate, 'CHUNK_SIZE', 5)
+    kmers = [kmer, "ACGT", "TTTT", "GGGGGGGGGGGG"]
+    all_locations = swga.locate.multi_binding_sites(
+        kmers, fastafile, workers=workers)
+    genome = Fasta(fastafile)
+    assert len(all_locations) == len(kmers)
+    for kmer, locations in zip(kmers, all_locations):
+        for record in genome.keys():
+            seq = str(genome[record])
+            expected = (
+                swga.locate.substr_indices(kmer, seq) +
+                swga.locate.substr_indices(swga.locate.revcomp(kmer), seq))
+            assert locations[record] == expected
+
+
 def test_locate_chromosome_ends(fastafile):
     ends = swga.locate.chromosome_ends(fastafile)
     assert ends['record1'] == [0, 15]
@@ -22,6 +43,59 @@ def test_locate_chromosome_ends(fastafile):
     assert ends['record3'] == [24, 31]
 
 
+def test_chromosome_ends_cached(fastafile, monkeypatch):
+    ends = swga.locate.chromosome_ends(fastafile)
+    layout = swga.locate.record_layout(fastafile)
+    assert layout == [['record1', 16], ['record2', 8], ['record3', 8]]
+
+    def fail(fp):
+        raise AssertionError("genome was opened again")
+    monkeypatch.setattr(swga.locate.Genome, 'open', staticmethod(fail))
+    assert swga.locate.chromosome_ends(fastafile) is ends
+
+
+def test_chromosome_ends_from_layout(tmpdir):
+    import os
+    fa = tmpdir.join("other.fa")
+    fa.write(">a\nACGTA\n>b\nACG\n")
+    layout = swga.locate.genome_layout(str(fa))
+    assert swga.locate.is_current_layout(str(fa), layout)
+    # Layouts from the workspace metadata are used while the genome is
+    # unchanged
+    layout['records'] = [['x', 2], ['y', 6]]
+    swga.locate.cache_chromosome_ends(str(fa), layout)
+    assert swga.locate.chromosome_ends(str(fa)) == {
+        'x': [0, 1], 'y': [2, 7]}
+    fa.write(">a\nACGTAA\n")
+    os.utime(str(fa), (layout['mtime'] + 10, layout['mtime'] + 10))
+    assert not swga.locate.is_current_layout(str(fa), layout)
+    assert swga.locate.chromosome_ends(str(fa)) == {'a': [0, 5]}
+
+
+def test_migrate_metadata(kmer, ws, fastafile):
+    import swga
+    import swga.workspace
+    db = swga.workspace._db
+    db.execute_sql('DROP TABLE _metadata')
+    db.execute_sql(
+        'CREATE TABLE _metadata (id INTEGER PRIMARY KEY, db_name TEXT, '
+        'version TEXT, fg_file TEXT, bg_file TEXT, ex_file TEXT, '
+        'fg_length INTEGER, bg_length INTEGER)')
+    db.execute_sql(
+        'INSERT INTO _metadata (db_name, version, fg_file) VALUES (?, ?, ?)',
+        ('swga.db', swga.__version__, fastafile))
+    # The version can be checked before the metadata is migrated
+    db.check_version(swga.__version__)
+    db.migrate_metadata()
+    assert json.loads(db.metadata.fg_records) == (
+        swga.locate.genome_layout(fastafile))
+    # Layouts stored by older versions are replaced
+    db.execute_sql('UPDATE _metadata SET fg_records = ?', ('[["a", 1]]',))
+    db.migrate_metadata()
+    assert json.loads(db.metadata.fg_records) == (
+        swga.locate.genome_layout(fastafile))
+
+
 def test_linearize_binding_sites(kmer, ws, fastafile):
     p = Primer.create(seq=kmer)
     p._update_locations(fastafile)
@@ -33,9 +107,53 @@ def test_linearize_binding_sites(kmer, ws, fastafile):
         start, end = ends
         assert start in linear_bind_sites
         assert end in linear_bind_sites
-        for site in p.locations[record]:
+        for site in p.record_locations(chr_ends)[record]:
             assert site in linear_bind_sites
 
 
+def test_pack_locations(kmer, fastafile):
+    locations = swga.locate.binding_sites(kmer, fastafile)
+    chr_ends = swga.locate.chromosome_ends(fastafile)
+    packed = swga.locate.pack_locations(locations, chr_ends)
+    sites = swga.locate.unpack_locations(packed)
+    assert list(sites) == sorted(sites)
+    unpacked = swga.locate.delinearize_binding_sites(sites, chr_ends)
+    assert unpacked == {
+        rec: sorted(locs) for rec, locs in locations.iteritems()}
+
+
+def test_migrate_json_locations(kmer, ws, fastafile):
+    import swga.workspace
+    locations = swga.locate.binding_sites(kmer, fastafile)
+    swga.workspace._db.metadata = dict(fg_file=fastafile)
+    swga.workspace._db.execute_sql(
+        "INSERT INTO primer (seq, fg_freq, bg_freq, ratio, active, _locations)"
+        " VALUES (?, 0, 0, 0, 0, ?)", (kmer, json.dumps(locations)))
+    swga.workspace._db.migrate_locations()
+    assert (swga.workspace._db.execute_sql('PRAGMA user_version').fetchone()[0]
+            == swga.workspace.PACKED_LOCATIONS_VERSION)
+    p = Primer.get(Primer.seq == kmer)
+    chr_ends = swga.locate.chromosome_ends(fastafile)
+    assert p.record_locations(chr_ends) == {
+        rec: sorted(locs) for rec, locs in locations.iteritems()}
+
+
 def test_revcomp():
     assert "ATGC" == swga.locate.revcomp("GCAT")
+
+
+def test_location_cache(ws, fastafile):
+    chr_ends = swga.locate.chromosome_ends(fastafile)
+    primers = []
+    for i, seq in enumerate(["AAGG", "ACGT", "TTTTTTTTTTTTTTTT"]):
+        p = Primer.create(_id=i + 1, seq=seq)
+        p._update_locations(fastafile)
+        primers.append(p)
+    cache = swga.locate.LocationCache(primers)
+    assert len(cache) == 3
+    assert 2 in cache and 4 not in cache
+    assert [p.seq for p in cache.primers([3, 1])] == ["TTTTTTTTTTTTTTTT", "AAGG"]
+    for p, sites in zip(primers, cache.sites([1, 2, 3])):
+        assert list(sites) == list(p.linear_locations)
+    assert (swga.locate.merge_sites(cache.sites([1, 2]), chr_ends).tolist() ==
+            swga.locate.linearize_binding_sites(primers[:2], chr_ends))
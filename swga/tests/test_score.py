@@ -15,6 +15,20 @@ def test_seq_diff():
     assert swga.stats.seq_diff(unsorted_seq) == diffs
 
 
+def test_site_metrics():
+    import random
+    random.seed(1)
+    sites = sorted(random.sample(xrange(100000), 500))
+    diffs = swga.stats.seq_diff(list(sites))
+    metrics = swga.stats.site_metrics(sites)
+    assert metrics.diffs.tolist() == sorted(diffs)
+    assert metrics.mean == swga.stats.mean(diffs)
+    assert abs(metrics.std - swga.stats.stdev(diffs)) < 1e-9
+    assert metrics.gini == swga.stats.gini(list(diffs))
+    assert metrics.max == max(diffs)
+    assert swga.stats.lorenz(metrics.diffs)[-1] == 1.0
+
+
 def test_default_score_set():
     expression = "fg_dist_mean/bg_dist_mean"
     primer_set = [1,2,3,4]
@@ -28,3 +42,81 @@ def test_default_score_set():
     assert score == 2.0/3.0
     assert '__builtins__' not in namespace.keys()
 
+
+def test_score_expression():
+    import numpy as np
+    import pytest
+    expr = swga.score.ScoreExpression("fg_dist_mean * fg_dist_gini / bg_dist_mean")
+    assert expr.variables == ('fg_dist_mean', 'fg_dist_gini', 'bg_dist_mean')
+    assert expr.vectorized
+    assert expr(fg_dist_mean=2.0, fg_dist_gini=0.5, bg_dist_mean=4.0,
+                set_size=3) == 0.25
+    scores = expr.evaluate_batch({
+        'fg_dist_mean': [2.0, 3.0], 'fg_dist_gini': [0.5, 1.0],
+        'bg_dist_mean': [4.0, 0.0]})
+    assert scores[0] == 0.25 and np.isinf(scores[1])
+
+    expr = swga.score.ScoreExpression("set_size if set_size > 2 else 0")
+    assert not expr.vectorized
+    assert expr.evaluate_batch({'set_size': [1, 3]}).tolist() == [0, 3]
+    assert swga.score.ScoreExpression("1").evaluate_batch(
+        {'set_size': [1, 3]}).tolist() == [1, 1]
+
+    with pytest.raises(NameError):
+        swga.score.ScoreExpression("fg_dist_max")
+    for bad in ("__import__('os')", "set_size.real", "set_size +"):
+        with pytest.raises(ValueError):
+            swga.score.ScoreExpression(bad)
+
+
+def test_score_sets(ws, fastafile):
+    import numpy as np
+    import swga.locate as locate
+    from swga.workspace import Primer, Set
+    chr_ends = locate.chromosome_ends(fastafile)
+    primers = []
+    for seq, bg_freq in [("AAGG", 0), ("ACGT", 0), ("TTTT", 2)]:
+        p = Primer.create(seq=seq, bg_freq=bg_freq)
+        p._update_locations(fastafile)
+        primers.append(p)
+    primer_sets = [["AAGG", "ACGT"], ["ACGT", "TTTT"], ["AAGG", "ACGT", "TTTT"]]
+    for i, seqs in enumerate(primer_sets):
+        Set.add(i + 1, [p for p in primers if p.seq in seqs], score=0)
+    expression = swga.score.ScoreExpression(
+        "fg_dist_mean * fg_dist_gini / bg_dist_mean + fg_max_dist / set_size")
+    locations = locate.LocationCache(primers, key='seq')
+    scores, metrics = swga.score.score_sets(
+        expression, primer_sets, locations, chr_ends, bg_length=1000)
+    # bg_dist_mean is infinite for the first set
+    assert metrics['bg_dist_mean'][0] == float('inf')
+    for seqs, batch_score in zip(primer_sets, scores):
+        set_primers = locations.primers(seqs)
+        expected, _, _ = swga.score.score_set(
+            primers=set_primers,
+            max_fg_bind_dist=0,
+            bg_dist_mean=swga.score.calculate_bg_dist_mean(
+                set_primers, 1000),
+            chr_ends=chr_ends,
+            score_fun=lambda **kw: swga.score.default_score_set(
+                expression, **kw),
+            interactive=True)
+        assert np.isclose(batch_score, expected)
+
+    sets = Set.primer_seqs_by_set()
+    assert sorted(sets[3]) == primer_sets[2]
+    Set.update_scores([1, 3], scores[[0, 2]], str(expression))
+    assert [s.score for s in Set.select().order_by(Set._id)] == [
+        scores[0], 0, scores[2]]
+    assert Set.get(Set._id == 3).scoring_fn == str(expression)
+
+
+def test_max_dist_lower_bound():
+    import numpy as np
+    chr_ends = {'rec1': [0, 99], 'rec2': [100, 199]}
+    sites = [np.array([10, 50, 90]), np.array([120, 160])]
+    # Largest distance is 199 - 160 = 39
+    for max_dist in (39, 40, 60, 200):
+        assert swga.score.max_dist_lower_bound(sites, chr_ends, max_dist) == 0
+    for max_dist in (1, 5, 20, 30):
+        bound = swga.score.max_dist_lower_bound(sites, chr_ends, max_dist)
+        assert max_dist < bound <= 39
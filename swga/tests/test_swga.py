@@ -10,20 +10,31 @@ import pytest
 def fastafile(request, testdata_fp):
     def fasta(fname):
         fa = os.path.join(testdata_fp, fname)
-        fai = fa + '.fai'
 
-        def rm_fai():
-            try:
-                os.remove(fai)
-            except OSError:
-                pass
+        def rm_indexes():
+            for index in (fa + '.fai', fa + '.swga2bit'):
+                try:
+                    os.remove(index)
+                except OSError:
+                    pass
 
-        request.addfinalizer(rm_fai)
+        request.addfinalizer(rm_indexes)
 
         return fa
     return fasta
 
 
+@pytest.fixture(scope='module', autouse=True)
+def rm_packed_genomes(request, testdata_fp):
+    """Later commands re-create the packed genomes after `fastafile` has
+    removed them, so they're removed again once all the tests are done."""
+    def rm_packed():
+        for fname in os.listdir(testdata_fp):
+            if fname.endswith('.fai') or fname.endswith('.swga2bit'):
+                os.remove(os.path.join(testdata_fp, fname))
+    request.addfinalizer(rm_packed)
+
+
 @pytest.fixture
 def fg_fasta(fastafile):
     """Foreground genome in integration tests"""
@@ -74,6 +85,10 @@ class TestIntegration:
         command = "swga find_sets --workers=2 --force --max_fg_bind_dist 1000000 --max_sets 10"
         check_call(command, shell=True)
 
+    def test_find_sets_score_workers(self):
+        command = "swga find_sets --workers=2 --score_workers=2 --force --max_fg_bind_dist 1000000 --max_sets 10"
+        check_call(command, shell=True)
+
     def test_export_sets(self):
         command = "swga export sets --limit 1 --order_by score"
         check_call(command, shell=True)
@@ -0,0 +1,30 @@
+import random
+
+import melting
+import pytest
+
+from swga import thermo
+
+
+def random_seqs(n, seed=0):
+    rand = random.Random(seed)
+    return ["".join(rand.choice("ACGT") for _ in range(rand.randint(2, 40)))
+            for _ in range(n)]
+
+
+@pytest.mark.parametrize('conditions', [
+    {},
+    {'uncorrected': True},
+    {'Na_c': 50.0, 'Mg_c': 0.0, 'dNTPs_c': 0.0},
+    {'Na_c': 50.0, 'Mg_c': 1.5, 'dNTPs_c': 0.2, 'DNA_c': 250.0}])
+def test_temps(conditions):
+    '''Batch melting temps must agree with melting.temp.'''
+    # Includes palindromes, lower-case and over-long sequences
+    seqs = random_seqs(500) + ["ACGT", "GAATTC", "acgtta", "AT", "A" * 33]
+    expected = [melting.temp(seq, **conditions) for seq in seqs]
+    assert thermo.temps(seqs, **conditions) == pytest.approx(expected)
+
+
+def test_temps_invalid():
+    with pytest.raises(KeyError):
+        thermo.temps(["ACGT", "ACNT"])
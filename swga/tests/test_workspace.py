@@ -42,6 +42,24 @@ class TestSets(object):
         _, created = Set.add(1, primers, score=1)
         assert not created
 
+    def test_set_writer(self, primers):
+        from swga.workspace import SetWriter
+        Set.add(0, primers[:2], score=1)
+        with SetWriter(flush_every=2) as writer:
+            # Sets already in the database or the buffer aren't added again
+            assert not writer.add(1, primers[:2], score=2)
+            assert writer.add(2, primers[2:5], score=3, set_size=3)
+            assert not writer.add(3, primers[4:1:-1], score=4)
+            assert writer.add(4, primers[5:6], score=5)
+            assert writer.add(5, primers, score=6)
+            # The first two were flushed
+            assert Set.select().count() == 3
+        assert Set.select().count() == 4
+        s = Set.get(Set._id == 2)
+        assert s.score == 3 and s.set_size == 3
+        assert sorted(s.primer_seqs()) == sorted(p.seq for p in primers[2:5])
+        assert len(Set.get(Set._id == 5).primer_seqs()) == len(primers)
+
     def test_bad_set_add(self):
         with pytest.raises(ValueError):
             Set.add(0, None, score=1)
@@ -57,3 +75,63 @@ class TestPrimers(object):
         primers = [{'seq': "AAAA"}]
         Primers.add(primers, add_revcomp=True)
         assert Primer.select().where(Primer.seq == "TTTT").count() == 1
+
+    def test_add_primers_in_chunks(self, monkeypatch):
+        '''Inserts bind at most SQLITE_MAX_VARIABLES parameters.'''
+        n_params = []
+        execute_sql = workspace._db.execute_sql
+
+        def counting_execute_sql(sql, params=None, *args, **kwargs):
+            n_params.append(len(params or ()))
+            return execute_sql(sql, params, *args, **kwargs)
+        monkeypatch.setattr(workspace._db, 'execute_sql', counting_execute_sql)
+        primers = [
+            {'seq': "%08d" % i, 'fg_freq': 1, 'bg_freq': 2, 'ratio': 0.5}
+            for i in range(1000)]
+        Primers.add(primers, add_revcomp=False)
+        assert Primer.select().count() == 1000
+        assert 0 < max(n_params) <= workspace.SQLITE_MAX_VARIABLES
+
+    def test_filter_chain(self):
+        '''Filters are applied together, and their counts found in one go.'''
+        workspace._db.index_primers()
+        for i in range(10):
+            Primer.create(seq="A" * (i + 1), fg_freq=i, bg_freq=i % 3)
+        primers = Primers()
+        primers.filter_min_fg_rate(2).filter_max_bg_rate(1)
+        assert primers._pending
+        assert len(primers) == 5
+        assert not primers._pending
+        # Ties in bg_freq are broken by sequence
+        primers.limit_to(3)
+        assert sorted(p.seq for p in primers) == ["AAAA", "AAAAAAA", "AAAAAAAAAA"]
+        primers.activate()
+        assert Primer.select().where(Primer.active == True).count() == 3
+
+    def test_update_in_chunks(self):
+        '''Only the given fields are written.'''
+        Primers.add([{'seq': "A" * (i + 1), 'fg_freq': i} for i in range(10)],
+                    add_revcomp=False)
+        primers = list(Primer.select())
+        for primer in primers:
+            primer.tm = primer.fg_freq * 2.0
+            primer.fg_freq = 0
+        Primers._update_in_chunks(primers, ['tm'], chunksize=3)
+        for primer in Primer.select():
+            assert primer.tm == primer.fg_freq * 2.0
+        assert Primer.select().where(Primer.fg_freq == 9).count() == 1
+
+
+def test_write_mode_restored(ws):
+    import swga.workspace as workspace
+    db = workspace._db
+
+    def pragma(name):
+        return str(db.execute_sql('PRAGMA ' + name).fetchone()[0]).lower()
+
+    journal_mode, synchronous = pragma('journal_mode'), pragma('synchronous')
+    with db.write_mode('WAL', 'OFF'):
+        assert pragma('journal_mode') == 'wal'
+        assert pragma('synchronous') == '0'
+    assert pragma('journal_mode') == journal_mode
+    assert pragma('synchronous') == synchronous
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""thermo.py
+
+Melting temperatures for many primers at once.
+
+Gives the same results as `melting.temp` (nearest-neighbor thermodynamics
+with the parameters of Allawi and SantaLucia (1997), corrected for salt
+concentrations), but works on arrays of 2-bit packed k-mers (see
+kmers.encode_kmers), so that a whole batch of primers takes a handful of
+NumPy operations instead of a Python loop over every base of every primer.
+"""
+from __future__ import division
+from collections import defaultdict
+from math import log, sqrt
+
+import numpy as np
+import melting
+
+from swga.kmers import encode_kmers
+
+# Universal gas constant (cal/(K*mol))
+R = 1.987
+
+# The order of the bases in packed k-mers (see kmers.encode_kmers). A base's
+# complement is its code xor 2.
+_BASES = "ACTG"
+_GC = [_BASES.index("C"), _BASES.index("G")]
+
+# Nearest-neighbor stack parameters, as used by melting.temp (Table 1 in
+# Allawi and SantaLucia (1997)): delta H (kcal/mol) and delta S (eu)
+_DH = {"AA": -7.9, "TT": -7.9, "AT": -7.2, "TA": -7.2,
+       "CA": -8.5, "TG": -8.5, "GT": -8.4, "AC": -8.4,
+       "CT": -7.8, "AG": -7.8, "GA": -8.2, "TC": -8.2,
+       "CG": -10.6, "GC": -9.8, "GG": -8.0, "CC": -8.0}
+_DS = {"AA": -22.2, "TT": -22.2, "AT": -20.4, "TA": -21.3,
+       "CA": -22.7, "TG": -22.7, "GT": -22.4, "AC": -22.4,
+       "CT": -21.0, "AG": -21.0, "GA": -22.2, "TC": -22.2,
+       "CG": -27.2, "GC": -24.4, "GG": -19.9, "CC": -19.9}
+
+
+def _stack_table(coeffs):
+    """Arrange stack parameters so that table[4 * code1 + code2] is the
+    parameter for the dinucleotide of bases code1, code2."""
+    return np.array([coeffs[b1 + b2] for b1 in _BASES for b2 in _BASES])
+
+DH_STACKS = _stack_table(_DH)
+DS_STACKS = _stack_table(_DS)
+
+
+def temps(seqs, **conditions):
+    """Return the melting temps of a list of sequences.
+
+    Sequences are packed and grouped by length. Any that can't be packed
+    (longer than 32 nt, or with bases other than ACGT) are passed to
+    melting.temp one at a time.
+
+    :param seqs: a list of nucleotide sequences
+    :param conditions: concentrations, as taken by melting.temp
+    :returns: a list of melting temps (C), in the same order as seqs
+    """
+    result = np.zeros(len(seqs))
+    by_length = defaultdict(list)
+    for i, seq in enumerate(seqs):
+        by_length[len(seq)].append(i)
+    for k, idx in by_length.items():
+        idx = np.array(idx)
+        if 1 < k <= 32:
+            packed, valid = encode_kmers([seqs[i].upper() for i in idx], k)
+            result[idx[valid]] = packed_temps(packed[valid], k, **conditions)
+            idx = idx[~valid]
+        for i in idx:
+            result[i] = melting.temp(seqs[i], **conditions)
+    return result.tolist()
+
+
+def packed_temps(kmers, k, DNA_c=5000.0, Na_c=10.0, Mg_c=20.0, dNTPs_c=10.0,
+                 uncorrected=False):
+    """Return the melting temps of an array of packed k-mers.
+
+    :param kmers: a uint64 array of k-mers, as packed by kmers.encode_kmers
+    :param k: the length of the k-mers
+    :param DNA_c: DNA concentration [nM]
+    :param Na_c: Na+ concentration [mM]
+    :param Mg_c: Mg2+ concentration [mM]
+    :param dNTPs_c: dNTP concentration [mM]
+    :param uncorrected: if True, don't correct for cation concentrations
+    :returns: an array of melting temps (C)
+    """
+    # The first base is stored in the most significant bits
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    codes = ((np.asarray(kmers, dtype=np.uint64)[:, None] >> shifts) &
+             np.uint64(3)).astype(np.intp)
+    stacks = codes[:, :-1] * 4 + codes[:, 1:]
+    dh = DH_STACKS[stacks].sum(axis=1)
+    ds = DS_STACKS[stacks].sum(axis=1)
+
+    # Terminal corrections
+    for end in (codes[:, 0], codes[:, -1]):
+        gc = np.in1d(end, _GC)
+        dh += np.where(gc, 0.1, 2.3)
+        ds += np.where(gc, -2.8, 4.1)
+    # Self-complementary k-mers
+    symmetric = (codes == (codes[:, ::-1] ^ 2)).all(axis=1)
+    ds -= np.where(symmetric, 1.4, 0)
+
+    tm = (1000 * dh) / (ds + R * log(DNA_c * 1e-9))
+    if uncorrected:
+        return tm - 273.15
+    tm = 1 / ((1 / tm) + _salt_correction(k, Na_c, Mg_c, dNTPs_c) * 1e-5)
+    tm -= 273.15
+    return np.where(tm < 0, 0, tm)
+
+
+def _salt_correction(k, Na_c, Mg_c, dNTPs_c):
+    """The cation correction to 1/Tm made by melting.temp (x 1e5), which
+    only depends on the concentrations and the length of the sequence."""
+    MNa = Na_c * 1e-3
+    MMg = Mg_c * 1e-3
+    MdNTPs = dNTPs_c * 1e-3
+    # melting.temp takes the length of a list holding one string as the GC
+    # count, so its GC fraction is always 1/k
+    fgc = 1 / k
+
+    # Free magnesium concentration
+    Ka = 3e4
+    D = (Ka * MdNTPs - Ka * MMg + 1)**2 + (4 * Ka * MMg)
+    Fmg = (-(Ka * MdNTPs - Ka * MMg + 1) + sqrt(D)) / (2 * Ka)
+    cation_ratio = sqrt(Fmg) / MNa if MNa > 0 else 7.0
+
+    if cation_ratio < 0.22:
+        return (4.29 * fgc - 3.95) * log(MNa) + 0.94 * log(MNa)**2
+    a = 3.92
+    d = 1.42
+    g = 8.31
+    Fmg = MMg
+    if cation_ratio < 6.0:
+        a = a * (0.843 - 0.352 * sqrt(MNa) * log(MNa))
+        d = d * (1.279 - 4.03 * log(MNa) * 1e-3 - 8.03 * log(MNa)**2 * 1e-3)
+        g = g * (0.486 - 0.258 * log(MNa) + 5.25 * log(MNa)**3 * 1e-3)
+    return (a - 0.911 * log(Fmg) + fgc * (6.26 + d * log(Fmg)) +
+            1 / (2 * (k - 1)) * (-48.2 + 52.5 * log(Fmg) + g * log(Fmg)**2))
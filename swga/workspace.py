@@ -8,6 +8,7 @@
 """
 
 import json
+import os
 import contextlib
 
 import semantic_version as semver
@@ -24,6 +25,15 @@ import melting
 import stats
 
 
+JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+# Recorded in the workspace's PRAGMA user_version once its primer locations
+# are known to be packed (see SwgaWorkspace.migrate_locations)
+PACKED_LOCATIONS_VERSION = 1
+# Primer columns indexed for filtering (see SwgaWorkspace.index_primers)
+PRIMER_INDEXES = ['fg_freq', 'bg_freq', 'ratio', 'tm', 'gini']
+
+
 class SwgaWorkspace(SqliteExtDatabase):
 
     """Extends a SqliteExtDatabase to add workspace metadata getting/setting."""
@@ -40,6 +50,43 @@ class SwgaWorkspace(SqliteExtDatabase):
         _metadata.delete().execute()
         _metadata.insert(db_name=self.database, **values).execute()
 
+    @contextlib.contextmanager
+    def write_mode(self, journal_mode=None, synchronous=None):
+        """Change how SQLite journals and syncs writes to the workspace.
+
+        WAL journaling with synchronous=NORMAL avoids most of the fsyncs done
+        by default, which dominate write-heavy commands like find_sets. The
+        journal mode is stored in the database file, so both settings are
+        restored when the context exits.
+
+        :param journal_mode: one of DELETE, TRUNCATE, PERSIST, MEMORY, WAL or
+        OFF (if None, unchanged)
+        :param synchronous: one of OFF, NORMAL, FULL or EXTRA (if None,
+        unchanged)
+        """
+        if journal_mode and journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError(
+                "journal_mode must be one of " + ", ".join(JOURNAL_MODES))
+        if synchronous and synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError(
+                "synchronous must be one of " + ", ".join(SYNCHRONOUS_MODES))
+        old_journal_mode = self.execute_sql('PRAGMA journal_mode').fetchone()[0]
+        old_synchronous = self.execute_sql('PRAGMA synchronous').fetchone()[0]
+        try:
+            if journal_mode:
+                self.execute_sql(
+                    'PRAGMA journal_mode = ' + journal_mode.upper())
+            if synchronous:
+                self.execute_sql('PRAGMA synchronous = ' + synchronous.upper())
+            yield
+        finally:
+            if synchronous:
+                self.execute_sql(
+                    'PRAGMA synchronous = {}'.format(int(old_synchronous)))
+            if journal_mode:
+                self.execute_sql(
+                    'PRAGMA journal_mode = ' + str(old_journal_mode).upper())
+
     def create_tables(self, safe=True):
         """Create the tables that subclass SwgaModel."""
         super(SwgaWorkspace, self).create_tables(_tables, safe=safe)
@@ -52,14 +99,41 @@ class SwgaWorkspace(SqliteExtDatabase):
         self.drop_tables([Set, PrimerSet, Primer])
         super(SwgaWorkspace, self).create_tables([Set, PrimerSet, Primer])
 
+    def migrate_metadata(self):
+        """Store the foreground genome's records in older workspaces.
+
+        Workspaces made by older versions of swga don't have the fg_records
+        column in their metadata. The records are stored again if the genome
+        has changed since they were.
+        """
+        if not _metadata.table_exists():
+            return
+        columns = [c.name for c in self.get_columns(_metadata._meta.db_table)]
+        if 'fg_records' not in columns:
+            self.execute_sql(
+                'ALTER TABLE "{}" ADD COLUMN "fg_records" TEXT'
+                .format(_metadata._meta.db_table))
+        m = _metadata.get()
+        if not (m.fg_file and os.path.isfile(m.fg_file)):
+            return
+        # Also updated if it was stored in an older format or the genome has
+        # changed since
+        stored = json.loads(m.fg_records) if m.fg_records else None
+        if not locate.is_current_layout(m.fg_file, stored):
+            (_metadata
+             .update(fg_records=json.dumps(locate.genome_layout(m.fg_file)))
+             .execute())
+
     def check_version(self, version):
         """Check the version of the database and compare it to the swga version.
 
         If the two versions are incompatible, raise a SystemExit.
         """
         try:
-            db_ver = self.metadata.version
-            db_ver = semver.Version(self.metadata.version)
+            # Only the version is read, since older workspaces might not have
+            # the other metadata columns yet (see migrate_metadata)
+            db_ver = semver.Version(
+                _metadata.select(_metadata.version).scalar())
         except pw.OperationalError:
             db_ver = "<NA>"
         ver = semver.Version(version)
@@ -76,6 +150,44 @@ class SwgaWorkspace(SqliteExtDatabase):
                 wrap=False
             )
 
+    def migrate_locations(self):
+        """Convert primer locations stored as JSON by older versions of swga.
+
+        Locations used to be stored as a JSON dict of {record: [sites]}; they
+        are now packed arrays of sites on the linearized foreground genome.
+
+        The primers are only checked once: afterwards, the workspace's
+        user_version records that its locations are packed.
+        """
+        user_version = self.execute_sql('PRAGMA user_version').fetchone()[0]
+        if user_version >= PACKED_LOCATIONS_VERSION:
+            return
+        legacy = list(Primer.select().where(
+            pw.fn.typeof(Primer._locations) == 'text'))
+        with self.atomic():
+            if legacy:
+                chr_ends = locate.chromosome_ends(self.metadata.fg_file)
+            for primer in legacy:
+                (Primer
+                 .update(_locations=locate.pack_locations(
+                     json.loads(primer._locations), chr_ends))
+                 .where(Primer.seq == primer.seq)
+                 .execute())
+            self.execute_sql(
+                'PRAGMA user_version = {}'.format(PACKED_LOCATIONS_VERSION))
+
+    def index_primers(self):
+        """Index the primer columns used by filters, if they aren't already.
+
+        The indexes aren't made along with the table, since keeping them up
+        to date while `swga count` adds millions of primers is much slower
+        than building them once afterwards.
+        """
+        for field in PRIMER_INDEXES:
+            self.execute_sql(
+                'CREATE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}")'
+                .format(Primer._meta.db_table, field))
+
 _db = SwgaWorkspace(None)
 
 
@@ -118,7 +230,7 @@ class Primer(SwgaModel):
     bg_freq = pw.IntegerField(default=0)
     ratio = pw.FloatField(default=0.0)
     tm = pw.FloatField(null=True)
-    _locations = pw.TextField(null=True)
+    _locations = pw.BlobField(null=True)
     gini = pw.FloatField(null=True)
     active = pw.BooleanField(default=False)
 
@@ -138,24 +250,33 @@ class Primer(SwgaModel):
         return rep_str
 
     @property
-    def locations(self):
-        if self._locations:
-            return json.loads(self._locations)
-        else:
+    def linear_locations(self):
+        """The sorted binding sites on the linearized foreground genome."""
+        if self._locations is None:
             error("No locations stored for " + str(self))
+        return locate.unpack_locations(self._locations)
+
+    def record_locations(self, chr_ends):
+        """Return the binding sites in each record, as {record: [sites]}.
+
+        :param chr_ends: the start and ends of each record in the foreground
+        genome, from `locate.chromosome_ends`
+        """
+        return locate.delinearize_binding_sites(
+            self.linear_locations, chr_ends)
 
     def update_tm(self):
         self.tm = melting.temp(self.seq)
 
     def _update_locations(self, genome_fp):
-        self._locations = json.dumps(
-            locate.binding_sites(self.seq, genome_fp))
+        self._locations = locate.pack_locations(
+            locate.binding_sites(self.seq, genome_fp),
+            locate.chromosome_ends(genome_fp))
 
     def _update_gini(self, genome_fp):
         chr_ends = locate.chromosome_ends(genome_fp)
-        locs = locate.linearize_binding_sites([self], chr_ends)
-        dists = stats.seq_diff(locs)
-        self.gini = stats.gini(dists)
+        locs = locate.merge_sites([self.linear_locations], chr_ends)
+        self.gini = stats.site_metrics(locs).gini
 
 
 class Set(SwgaModel):
@@ -231,8 +352,104 @@ class Set(SwgaModel):
             s.primers.add(primers)
         return s, created
 
+    @staticmethod
+    def update_scores(ids, scores, scoring_fn):
+        """Write new scores for many sets, in a single transaction.
+
+        :param ids: the set IDs
+        :param scores: the new score of each set
+        :param scoring_fn: the expression the sets were scored with
+        """
+        sql = 'UPDATE "{}" SET "{}" = ?, "{}" = ? WHERE "{}" = ?'.format(
+            Set._meta.db_table, Set.score.db_column,
+            Set.scoring_fn.db_column, Set._id.db_column)
+        with _db.atomic():
+            _db.get_cursor().executemany(sql, [
+                (float(score), scoring_fn, _id)
+                for _id, score in zip(ids, scores)])
+
+    @staticmethod
+    def primer_seqs_by_set():
+        """Return the sequences of the primers in each set, by set ID."""
+        sets = {}
+        rows = PrimerSet.select(PrimerSet.set, PrimerSet.primer).tuples()
+        for set_id, seq in rows:
+            sets.setdefault(set_id, []).append(seq)
+        return sets
+
 PrimerSet = Set.primers.get_through_model()
 
+# The most parameters SQLite allows in one statement (in older versions)
+SQLITE_MAX_VARIABLES = 999
+
+
+class SetWriter(object):
+
+    """Adds many sets to the database in bulk.
+
+    Sets are buffered and inserted (along with their primers) `flush_every`
+    at a time in a single transaction, instead of one transaction per set.
+    Duplicate sets are skipped in memory, as in `Set.add`.
+
+    Use as a context manager to make sure the last sets are written:
+
+        with SetWriter() as writer:
+            writer.add(_id, primers, score=...)
+    """
+
+    def __init__(self, flush_every=1000):
+        self.flush_every = flush_every
+        self.written = 0
+        self._sets = []
+        self._primer_sets = []
+        self._hashes = set(s._hash for s in Set.select(Set._hash))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, _id, primers, **kwargs):
+        """Buffer a set to be added to the database.
+
+        :param _id: the set ID
+        :param primers: a list of Primer objects in the set
+        :param kwargs: the other Set fields (score, set_size, etc)
+        :return: True if the set will be added or False if it's a duplicate
+        """
+        if len(primers) == 0:
+            raise ValueError("Cannot add an empty set.")
+        _hash = hash(frozenset([p.seq for p in primers]))
+        if _hash in self._hashes:
+            return False
+        self._hashes.add(_hash)
+        row = {name: None for name in Set._meta.fields}
+        row.update(kwargs, _id=_id, _hash=_hash)
+        self._sets.append(row)
+        self._primer_sets += [{'set': _id, 'primer': p.seq} for p in primers]
+        if len(self._sets) >= self.flush_every:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Write all the buffered sets to the database."""
+        if not self._sets:
+            return
+        with _db.atomic():
+            _insert_in_chunks(Set, self._sets)
+            _insert_in_chunks(PrimerSet, self._primer_sets)
+        self.written += len(self._sets)
+        self._sets = []
+        self._primer_sets = []
+
+
+def _insert_in_chunks(model, rows):
+    """Insert rows with as few statements as SQLite's parameter limit allows."""
+    n = max(1, SQLITE_MAX_VARIABLES // len(rows[0]))
+    for i in xrange(0, len(rows), n):
+        model.insert_many(rows[i:i + n]).execute()
+
 
 class _metadata(SwgaModel):
 
@@ -245,6 +462,33 @@ class _metadata(SwgaModel):
     ex_file = pw.TextField(null=True)
     fg_length = pw.IntegerField(null=True)
     bg_length = pw.IntegerField(null=True)
+    # The genome_layout of the foreground genome, as JSON
+    fg_records = pw.TextField(null=True)
+
+
+class _graph_cache(SwgaModel):
+
+    """The last compatibility graph written by find_sets (internal)."""
+
+    # sha1 of everything written to the graph file (see graph.graph_key)
+    key = pw.TextField()
+    # Identifies the graph file as it was written
+    graph_size = pw.IntegerField(null=True)
+    graph_mtime = pw.FloatField(null=True)
+
+
+class _dimers(SwgaModel):
+
+    """The longest heterodimer between pairs of primers (internal).
+
+    Each sequence gets the next idx when it's first added. Its lengths are a
+    uint8 array holding max_sequential_nt between it and the sequences with
+    idx 0, 1, ..., idx (itself), so the table grows as a triangular matrix.
+    """
+
+    seq = pw.CharField(primary_key=True)
+    idx = pw.IntegerField(unique=True)
+    lengths = pw.BlobField()
 
 
 # Uses new-class introspection to find all the models that subclass SwgaModel,